@@ -31,26 +31,44 @@ from xml.etree import ElementTree
 from dataclasses import field,make_dataclass
 
 class driverBase:
+  INIT_TIMEOUT = 10 # Seconds startup waits for init() before moving on
+  VOLUME_RANGE = (0, 100) # Levels of volume-get/set, the highest being 0dB
+
   def __init__(self, *args):
     self.power = False
     self.COMMAND_HANDLER = {}
+    self.COMMAND_VIEW = None
+    self.initialized = False
     self.httpTimeout = 250 # 250ms
     self.httpRetries = 2
     self.handlers = []
     self.eventManager = None
+    self.eventName = None
 
     # Setup a requests session to gain persistent connections
     self.resetSession()
 
-    # Invoke the real init function
-    self.init(*args)
+    # The real init function is invoked by initialize(), which allows
+    # all drivers to initialize at the same time
+    self.initArgs = args
+
+  def initialize(self):
+    """ Invokes init() with the arguments given when created
+    """
+    self.init(*self.initArgs)
+    # Drivers may fill COMMAND_HANDLER directly, so don't trust the view
+    self.COMMAND_VIEW = None
+    self.initialized = True
 
   def resetSession(self):
     logging.info('Initialized new requests session')
     self.session = requests.Session()
 
-  def setEventManager(self, eventManager):
+  def setEventManager(self, eventManager, name=None):
+    """ name is the device name, used as topic for events from this driver
+    """
     self.eventManager = eventManager
+    self.eventName = name
 
   def init(self):
     """ Override to do additional initialization
@@ -184,12 +202,13 @@ class driverBase:
         """
     self.handlers.append({'handler':handler, 'commands': cmds})
 
-  def addCommand(self, command, cmdtype, handler, name = None, desc = None, extras = None, args = 0):
+  def addCommand(self, command, cmdtype, handler, name = None, desc = None, extras = None, args = 0, flags = CommandType.FLAG_NONE):
     """ Convenience function, allows adding commands to the list which
         is exposed by getCommands() and handleCommand()
     """
     name = command
     desc = name
+    self.COMMAND_VIEW = None
 
     if extras == None:
       self.COMMAND_HANDLER[command] = {
@@ -197,7 +216,8 @@ class driverBase:
         "handler"     : handler,
         "name"        : name,
         "description" : desc,
-        "type"        : cmdtype
+        "type"        : cmdtype,
+        "flags"       : flags
       }
     else:
       self.COMMAND_HANDLER[command] = {
@@ -206,6 +226,7 @@ class driverBase:
         "name"        : name,
         "description" : desc,
         "type"        : cmdtype,
+        "flags"       : flags,
         "extras"      : extras
       }
 
@@ -257,15 +278,10 @@ class driverBase:
         the only exception is power commands, they are ALWAYS called
         through the setPower() function.
 
-        -- FUTURE: --
-        Eventually it will do low-level handling of state, what that
-        means is that certain command types will be grouped and multiple
-        calls to the same command will only execute the first one.
-        For example, calling input-hdmi1 three times will only execute
-        the first time. This is to avoid unnecessary latencies.
-
-        A driver will be able to override this behavior by adding a flag
-        to the command definition.
+        Commands which carry the FLAG_KEEP_STATE flag are grouped by
+        type (see getCommandGroup()), which allows the router to only
+        send them when they change. For example, switching route while
+        the receiver stays on input-bd will not send input-bd again.
     """
     '''
     result = None
@@ -291,18 +307,47 @@ class driverBase:
         else:
           result = item["handler"](zone)
       elif item["arguments"] == 1:
+        # Argument may be provided as-is or as a list
+        if isinstance(argument, (list, tuple)):
+          argument = argument[0]
         if "extras" in item:
-          result = item["handler"](zone, argument[0], item["extras"])
+          result = item["handler"](zone, argument, item["extras"])
         else:
-          result = item["handler"](zone, argument[0])
+          result = item["handler"](zone, argument)
       return result
     except:
       logging.exception("Exception executing command %s for zone %s" % (repr(command), repr(zone)))
       return None
 
 
+  def getCommandGroup(self, command):
+    """ API: Returns the group of a command flagged with FLAG_KEEP_STATE,
+        which is its type. Only one command per group can be in effect,
+        so sending input-bd after input-dvd replaces it.
+
+        Returns None if the state of the command isn't tracked.
+    """
+    if command not in self.COMMAND_HANDLER:
+      return None
+    item = self.COMMAND_HANDLER[command]
+    if not item.get("flags", CommandType.FLAG_NONE) & CommandType.FLAG_KEEP_STATE:
+      return None
+    return item["type"]
+
   def getCommands(self):
-    """ API: Returns the list of supported commands. For now it also limits this
+    """ API: Returns the list of supported commands. The list is compiled
+        once (see compileCommands()) and reused, so callers must not change
+        it. Adding commands causes it to be compiled again. Until the driver
+        has been initialized there are no commands.
+    """
+    if not self.initialized:
+      return {}
+    if self.COMMAND_VIEW is None:
+      self.COMMAND_VIEW = self.compileCommands()
+    return self.COMMAND_VIEW
+
+  def compileCommands(self):
+    """ Compiles the list of supported commands. For now it also limits this
         list depending on the type. This is less than ideal, but for now
         this is how it's done.
     """
@@ -327,4 +372,4 @@ class driverBase:
 
   def sendEvent(self, eventType, eventSource, eventData, zone=None):
     #         self.events.notify(None, {"type":"zone", "source" : remote, "data": {"zone" : zone, "inuse" : True}})
-    self.eventManager.notify(zone, {"type":eventType, "source":eventSource, "data":eventData})
+    self.eventManager.notify(zone, {"type":eventType, "source":eventSource, "data":eventData}, self.eventName)
@@ -23,6 +23,7 @@ import logging
 
 class driverRxv1900(driverBase):
   cfg_YamahaController = None
+  VOLUME_RANGE = (0, 10000)
 
   # Will be filled out by init
   RESPONSE_HANDLER = {}
@@ -396,41 +397,47 @@ class driverRxv1900(driverBase):
         "arguments"   : 0,
         "handler"     : self.setInput, "extras" : "input-mdcdr",
         "name"        : "Input MD/CDR",
-        "type"        : CommandType.PRIVATE_INPUT
+        "type"        : CommandType.PRIVATE_INPUT,
+        "flags"       : CommandType.FLAG_KEEP_STATE
       },
       "input-bd"      : {
         "arguments"   : 0,
         "handler"     : self.setInput, "extras" : "input-bd",
         "name"        : "Input BD",
-        "type"        : CommandType.PRIVATE_INPUT
+        "type"        : CommandType.PRIVATE_INPUT,
+        "flags"       : CommandType.FLAG_KEEP_STATE
       },
       "input-dvd"     : {
         "arguments"   : 0,
         "handler"     : self.setInput, "extras" : "input-dvd",
         "name"        : "Input DVD",
-        "type"        : CommandType.PRIVATE_INPUT
+        "type"        : CommandType.PRIVATE_INPUT,
+        "flags"       : CommandType.FLAG_KEEP_STATE
       },
       "input-dvr"   : {
         "arguments"   : 0,
         "handler"     : self.setInput, "extras" : "input-dvr",
         "name"        : "Input DVR",
-        "type"        : CommandType.PRIVATE_INPUT
+        "type"        : CommandType.PRIVATE_INPUT,
+        "flags"       : CommandType.FLAG_KEEP_STATE
       },
       "input-cbl"      : {
         "arguments"   : 0,
         "handler"     : self.setInput, "extras" : "input-cbl",
         "name"        : "Input CBL",
-        "type"        : CommandType.PRIVATE_INPUT
+        "type"        : CommandType.PRIVATE_INPUT,
+        "flags"       : CommandType.FLAG_KEEP_STATE
       },
       "input-cd"      : {
         "arguments"   : 0,
         "handler"     : self.setInput, "extras" : "input-cd",
         "name"        : "Input CD",
-        "type"        : CommandType.PRIVATE_INPUT
+        "type"        : CommandType.PRIVATE_INPUT,
+        "flags"       : CommandType.FLAG_KEEP_STATE
       },
     }
 
-  def getCommands(self):
+  def compileCommands(self):
     ret = {}
     for c in self.COMMAND_HANDLER:
       ret[c] = {"name": "", "description": ""}
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+#
+# This file is part of multiRemote.
+#
+# multiRemote is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# multiRemote is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with multiRemote.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Measures how long it takes to parse and validate setup.conf files of
+various sizes. Generates synthetic configurations with the requested
+number of devices and reports the best of a number of runs.
+
+Run from the root of multiRemote:
+
+  python3 extras/parserbench.py [--runs N] [devices ...]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from modules.parser import SetupParser
+
+def generate(devices):
+  """
+  Creates a configuration with a receiver, a tv and sources making up
+  the rest of the devices. Every source gets a scene and every ten
+  sources share a zone.
+  """
+  sources = max(1, devices - 2)
+  zones = max(1, sources // 10)
+  lines = [
+    'options',
+    '  remote pin 1234',
+    '  ux server http://localhost:5000/ux/',
+    '',
+    'device receiver',
+    '  uses driver base',
+    '  has %d zones' % zones,
+    '',
+    'device tv',
+    '  uses driver base',
+    '',
+  ]
+  for i in range(sources):
+    lines += [
+      'device source%d' % i,
+      '  uses driver base with options "source %d", 0.5' % i,
+      '  path audio requires receiver (input-%d)' % i,
+      '  path audio+video requires tv (input-hdmi%d, mode-game), receiver (input-%d)' % (i % 4, i),
+      '',
+      'scene scene%d: Scene %d' % (i, i),
+      '  uses device source%d with options app=%d' % (i, i),
+      '  described as "Scene number %d"' % i,
+      '  requires audio+video',
+      '',
+    ]
+  for i in range(zones):
+    lines += [
+      'zone zone%d: Zone %d' % (i, i),
+      '  default subzone tv',
+      '  subzone tv: TV',
+      '    audio uses receiver zone %d' % (i + 1),
+      '    video uses tv',
+      '  subzone speakers: Speakers',
+      '    audio uses receiver zone %d' % (i + 1),
+      '',
+    ]
+  return '\n'.join(lines) + '\n'
+
+def measure(filename, runs):
+  best = None
+  for _ in range(runs):
+    parser = SetupParser()
+    config = {}
+    start = time.perf_counter()
+    if not parser.parse(filename, config):
+      raise Exception('Generated configuration failed to parse')
+    parsed = time.perf_counter()
+    issues = parser.findIssues(config)
+    done = time.perf_counter()
+    if isinstance(issues, str):
+      raise Exception('Generated configuration is invalid: ' + issues)
+    result = (parsed - start, done - parsed)
+    if best is None or sum(result) < sum(best):
+      best = result
+  return best
+
+if __name__ == "__main__":
+  cmdline = argparse.ArgumentParser(description="Benchmarks parsing of setup.conf")
+  cmdline.add_argument('--runs', default=5, type=int, help="Number of runs per size, best is reported")
+  cmdline.add_argument('devices', nargs='*', default=[10, 100, 1000], type=int, help="Number of devices to generate")
+  args = cmdline.parse_args()
+
+  print('%8s %8s %12s %12s %12s' % ('devices', 'lines', 'parse', 'findIssues', 'total'))
+  for devices in args.devices:
+    with tempfile.NamedTemporaryFile('w', suffix='.conf', delete=False) as f:
+      f.write(generate(devices))
+      filename = f.name
+    try:
+      with open(filename) as f:
+        lines = sum(1 for _ in f)
+      parse, issues = measure(filename, args.runs)
+      print('%8d %8d %10.2fms %10.2fms %10.2fms' % (devices, lines, parse * 1000, issues * 1000, (parse + issues) * 1000))
+    finally:
+      os.unlink(filename)
@@ -4,16 +4,20 @@ import time
 import logging
 import json
 from inspect import signature
+from concurrent.futures import Future
 
-import flask
 
 from modules.remotemgr import RemoteManager
 from modules.router import Router
 from modules.core import Core
 from modules.ssdp import SSDPHandler
 from modules.parser import SetupParser
+from modules.registry import DriverRegistry
 from modules.eventmgr import EventHandler
 from modules.webhook import WebhookManager
+from modules.executor import DriverExecutor, then, gather
+from modules.ramp import VolumeRamp
+from modules.commandtype import CommandType
 
 def alwaysObject(x):
   return "***Unknown***"
@@ -22,10 +26,15 @@ class multiremoteAPI:
     def __init__(self):
         pass
 
-    def init(self, cmdline):
-        parser = SetupParser()
+    def init(self, cmdline, funcSchedule):
+        """
+        funcSchedule(task, *args) runs task on the thread handling the API
+        """
+        self.funcSchedule = funcSchedule
+        self.registry = DriverRegistry()
+        parser = SetupParser(self.registry)
         self.setup = {}
-        if not parser.load("conf/setup.conf", self.setup):
+        if not parser.load("conf/setup.conf", self.setup, "conf/setup.cache"):
             logging.error('Failed to load "setup.conf"')
             return False
 
@@ -34,9 +43,13 @@ class multiremoteAPI:
                 logging.warning("You're using hosted UX, make sure \"%s\" points to the right server", self.setup['OPTIONS']["ux-server"])
                 logging.warning('It should use port %d and end with /ux/' % cmdline.port)
 
+        self.executor = DriverExecutor()
         self.remotes  = RemoteManager()
-        self.core     = Core(self.setup, self.remotes)
-        self.router   = Router(self.core)
+        self.core     = Core(self.setup, self.remotes, self.executor)
+        parser.saveCache(self.core.ROUTES, self.core.getInconclusiveRoutes())
+        self.router   = Router(self.core, self.executor)
+        self.core.setRouter(self.router)
+        self.ramp     = VolumeRamp(self.core, self.executor, self.setup['OPTIONS'].get('ramp-rate'), self.setup['OPTIONS'].get('ramp-step'))
         self.ssdp     = SSDPHandler(self.setup['OPTIONS']["ux-server"], cmdline.port)
         self.events   = EventHandler(self.core)
         self.webhooks = WebhookManager()
@@ -51,10 +64,21 @@ class multiremoteAPI:
           self.webhooks.register_attribute('%s.subzone' % zone)
 
         self.events.registerCommand('execute', self.handleCommand)
+        self.buildDispatch()
 
-        # Also assign the eventmanager to all drivers
-        for _, v in self.setup['DRIVER_TABLE'].items():
-          v.setEventManager(self.events)
+        # Also assign the eventmanager to all drivers and give them a lane
+        for k, v in self.setup['DRIVER_TABLE'].items():
+          v.setEventManager(self.events, k)
+          self.executor.addDriver(k, v)
+
+        # Drivers may add commands while initializing
+        self.registry.initialize(self.executor, self.setup['DRIVER_TABLE'], lambda device: self.core.invalidateCommands())
+
+    def shutdown(self):
+        """
+        Makes sure nothing is lost when the server is stopped
+        """
+        self.remotes.flush()
 
     def getStatus(self):
         msg = {"status": "ok"}
@@ -130,6 +154,8 @@ class multiremoteAPI:
       elif not self.core.hasSubZone(zone, subzone):
         ret["error"] = "Zone does not have specified subzone"
       else:
+        # The subzone may use another audio device, the ramp would keep using the old one
+        self.ramp.stopRamp(zone)
         self.core.setSubZone(zone, subzone)
         self.router.updateRoutes()
         ret["subzone"] = self.core.getSubZone(zone)
@@ -156,6 +182,7 @@ class multiremoteAPI:
         if scene == None:
           ret["scenes"] = self.core.getSceneListForZone(zone)
         else:
+          self.ramp.stopRamp(zone)
           conflict = self.core.checkConflict(zone, scene)
           if conflict is None:
             self.core.setZoneScene(zone, scene)
@@ -179,9 +206,11 @@ class multiremoteAPI:
         self.events.notify(zone, {"type":"scene", "source" : remote, "data": {"scene" : self.core.getZoneScene(zone) } })
         self.events.notify(None, {"type":"zone", "source" : remote, "data": {"zone" : zone, "inuse" : True}})
 
-        self.webhooks.update_attribute(zone, WebhookManager.ACTIVE)
-        self.webhooks.update_attribute('%s.scene' % zone, self.core.getZoneScene(zone))
-        self.webhooks.update_attribute('%s.subzone' % zone, self.core.getSubZone(zone))
+        self.webhooks.update_attributes({
+          zone : WebhookManager.ACTIVE,
+          '%s.scene' % zone : self.core.getZoneScene(zone),
+          '%s.subzone' % zone : self.core.getSubZone(zone),
+        })
 
       return ret
 
@@ -195,14 +224,17 @@ class multiremoteAPI:
       if zone == None:
         ret["zones"] = self.core.getZoneList()
       else:
+        self.ramp.stopRamp(zone)
         self.core.clearZoneScene(zone)
         self.core.clearSubZone(zone)
         self.events.notify(zone, {"type":"scene", "source" : remote, "data": {"scene" : None } })
         self.events.notify(None, {"type":"zone", "source" : remote, "data": {"zone" : zone, "inuse" : False}})
 
-        self.webhooks.update_attribute(zone, WebhookManager.INACTIVE)
-        self.webhooks.update_attribute('%s.scene' % zone, WebhookManager.EMPTY)
-        self.webhooks.update_attribute('%s.subzone' % zone, WebhookManager.EMPTY)
+        self.webhooks.update_attributes({
+          zone : WebhookManager.INACTIVE,
+          '%s.scene' % zone : WebhookManager.EMPTY,
+          '%s.subzone' % zone : WebhookManager.EMPTY,
+        })
 
 
       self.router.updateRoutes()
@@ -226,9 +258,7 @@ class multiremoteAPI:
           if not zone is None:
             # Assign the remote to this zone
             self.core.setRemoteZone(remote, zone)
-            state = self.core.updateZoneState(zone, remote)
-            state['zone'] = zone
-            self.events.notify(None, {"type":"state", "source" : None, "data": state})
+            then(self.core.updateZoneState(zone, remote), lambda state: self.notifyZoneState(zone, state))
             ret["users"] = self.core.getZoneRemoteList(zone)
           # Show the zone active for this remote
           ret["active"] = self.core.getRemoteZone(remote)
@@ -237,6 +267,10 @@ class multiremoteAPI:
 
       return ret
 
+    def notifyZoneState(self, zone, state):
+      state['zone'] = zone
+      self.events.notify(None, {"type":"state", "source" : None, "data": state})
+
     def detachRemote(self, remote):
       """
       Detaches a remote from the selected zone.
@@ -260,10 +294,12 @@ class multiremoteAPI:
 
       /command/<remote>/<category>/<command>/<arguments>
       Executes said command supplied argument
+
+      When a command is executed, the result is a future since the
+      command runs on the lane of the driver.
       """
       ret = {}
       lst = self.core.getRemoteCommands(remote)
-      result = None
 
       if category == None:
         ret["zone"] = self.core.getRemoteZone(remote)
@@ -271,28 +307,67 @@ class multiremoteAPI:
       elif category == "zone":
         if command not in lst["zone"]:
           ret["error"] = "%s is not a zone command" % command
+        elif lst["zone"][command]["type"] in [CommandType.VOLUME_UP, CommandType.VOLUME_DOWN] and self.ramp.absorb(self.core.getRemoteZone(remote), lst["zone"][command]["type"]):
+          # A ramp is running, it will take care of this on its next tick
+          ret["result"] = "ok"
         else:
-          result = self.core.execZoneCommand(remote, command, arguments)
-          if result == False or result == None:
-            ret["error"] = "%s failed" % command
-          elif result == True:
-            ret["result"] = "ok"
-          else:
-            # Advanced driver :)
-            ret = result
-            ret["result"] = "ok"
-            logging.debug('Result contains: ' + repr(result))
+          # Driver executes this on its own lane, result is a future
+          return then(self.core.execZoneCommand(remote, command, arguments), lambda result: self.zoneCommandResult(command, result))
       elif category == "scene":
         if command not in lst["scene"]:
           ret["error"] = "%s is not a scene command" % command
-        elif self.core.execSceneCommand(remote, command, arguments):
-          ret["result"] = "ok"
         else:
-          ret["error"] = "%s failed" % command
+          return then(self.core.execSceneCommand(remote, command, arguments), lambda result: self.sceneCommandResult(command, result))
       else:
         ret["error"] = "%s is not a supported category" % category
       return ret
 
+    def rampVolume(self, remote, direction):
+      """
+      /ramp/<remote>/<up|down|stop>
+      Starts or stops changing the volume of the zone the remote is
+      attached to, meant for press-and-hold buttons. Start the ramp when
+      the button is pressed and stop it when released.
+      """
+      ret = {}
+      zone = self.core.getRemoteZone(remote)
+      if zone is None:
+        ret["error"] = "Remote is not attached to a zone"
+      elif direction == "stop":
+        self.ramp.stopRamp(zone)
+        ret["ramp"] = direction
+      elif direction in ["up", "down"]:
+        err = self.ramp.startRamp(zone, 1 if direction == "up" else -1)
+        if err is not None:
+          ret["error"] = err
+        else:
+          ret["ramp"] = direction
+      else:
+        ret["error"] = "%s is not a valid direction" % direction
+      ret["zone"] = zone
+      return ret
+
+    def zoneCommandResult(self, command, result):
+      ret = {}
+      if result == False or result == None:
+        ret["error"] = "%s failed" % command
+      elif result == True:
+        ret["result"] = "ok"
+      else:
+        # Advanced driver :)
+        ret = result
+        ret["result"] = "ok"
+        logging.debug('Result contains: ' + repr(result))
+      return ret
+
+    def sceneCommandResult(self, command, result):
+      ret = {}
+      if result:
+        ret["result"] = "ok"
+      else:
+        ret["error"] = "%s failed" % command
+      return ret
+
     def getDebugInformation(self):
       """
       Handy endpoint which prints out current routing/state of the system,
@@ -302,12 +377,19 @@ class multiremoteAPI:
         "routes" : self.core.getCurrentState(),
         "remotes" : self.remotes.list(),
         "subscribers" : [],
+        "topics" : self.events.getTopics(),
+        "queues" : self.events.getStatus(),
+        "lanes" : self.executor.getStatus(),
+        "router" : self.router.getStatus(),
+        "ramps" : self.ramp.getStatus(),
+        "drivers" : self.registry.getStatus(),
         "config" : {
           "scenes" : self.core.getSceneList(),
           "zones" : self.core.getZoneList(),
+          "inconclusive" : self.core.getInconclusiveRoutes(),
         }
       }
-      for l in self.events.remotes:
+      for l in self.events.getRemoteList():
         ret["subscribers"].append(l.uuid)
       return ret
 
@@ -382,62 +464,164 @@ class multiremoteAPI:
     def hasRemote(self, uuid):
       return self.remotes.has(uuid)
 
+    def getWebhookStatus(self):
+      """
+      Shows how calls to webhooks have fared, per host
+      """
+      return self.webhooks.get_status()
+
     def getSSDPDescriptor(self):
       return self.ssdp.generateXML()
 
-    def handleCommand(self, remote, data):
-      logging.debug('Contents: ' + repr(data))
-      obj = json.loads(data)
-      logging.debug('Data in message says: %s', repr(obj))
-      measure = time.time()
-
+    def buildDispatch(self):
+      """
+      Builds the table used by handleCommand() to dispatch websocket
+      requests. The number of arguments each function takes is figured
+      out here once, so it doesn't have to be done per request.
+      """
       mapping = {
         'attach' : self.attachRemote,
         'subzone' : self.getSubZone,
         'zone' : self.getZone,
         'assign' : self.assignZone,
         'command' : self.executeCommand,
+        'ramp' : self.rampVolume,
         'unassign' : self.unassignZone,
         'scene' : self.getScene,
         'detach' : self.detachRemote,
         'debug' : self.getDebugInformation,
         'register' : self.registerRemote,
         'unregister' : self.unregisterRemote,
-        'remotes' : self.remotes,
-
+        'remotes' : self.getRemotes,
+        'webhooks' : self.getWebhookStatus,
       }
-      parts = obj['addr'][1:].split('/')
-
-      if parts[0] in mapping:
-        # Figure out how many parameters it expects and substitute with None
-        sig = signature(mapping[parts[0]])
-        delta = len(sig.parameters) - len(parts) + 1
-        if delta < 0:
-          logging.error('We were provided MORE parameters than expected, abort!')
+      self.dispatch = {}
+      for name, func in mapping.items():
+        self.dispatch[name] = (func, len(signature(func).parameters))
+
+    def executeAddress(self, addr):
+      """
+      Executes the API function pointed to by addr (same layout as the
+      REST end-points, ie, /assign/<zone>/<remote>/<scene>). Missing
+      arguments are passed as None. Returns the result (which may be a
+      future) or an error.
+      """
+      parts = addr[1:].split('/')
+      if parts[0] not in self.dispatch:
+        logging.warning('Unregistered mapping: %s', parts[0])
+        return {"error" : "%s is not a supported command" % parts[0]}
+
+      func, arity = self.dispatch[parts[0]]
+      args = parts[1:]
+      if len(args) > arity:
+        logging.error('We were provided MORE parameters than expected for %s, abort!', parts[0])
+        return {"error" : "%s takes at most %d arguments" % (parts[0], arity)}
+      args.extend([None] * (arity - len(args)))
+      return func(*args)
+
+    def isFailure(self, result):
+      """
+      Anything which didn't perform the requested change counts as
+      a failure, including an assign that ran into a conflict.
+      """
+      if isinstance(result, Exception):
+        return True
+      return isinstance(result, dict) and ("error" in result or "conflict" in result)
+
+    def executeBatch(self, addrs, keepGoing):
+      """
+      Executes a list of addresses in order, in one go. Execution stops
+      at the first item which fails and the remaining items are skipped,
+      unless keepGoing is set.
+
+      Each item starts once the previous one is done, including the
+      driver command and any route change it caused, so a command never
+      reaches a device before the power on or input switch of an earlier
+      item. Returns a future holding the result of the batch.
+      """
+      batch = Future()
+      results = []
+
+      def step():
+        if len(results) == len(addrs):
+          batch.set_result(self.batchResult(addrs, results))
           return
-        #logging.debug('Delta is %d', delta)
-        for x in range(0, delta):
-          parts.append(None)
-        if len(parts) > 1:
-          result = mapping[parts[0]](*parts[1:])
+        addr = addrs[len(results)]
+        try:
+          result = self.executeAddress(addr)
+        except Exception as e:
+          logging.exception('Batch failed to execute %s', addr)
+          result = e
+        # Drivers and the router complete on their own threads, continue on ours
+        gather([result, self.router.settled()]).add_done_callback(lambda f: self.funcSchedule(done, f.result()[0]))
+
+      def done(result):
+        results.append(result)
+        if not keepGoing and self.isFailure(result):
+          batch.set_result(self.batchResult(addrs, results))
         else:
-          result = mapping[parts[0]]()
-
-        retstr = json.dumps(
-          {
-            'type' : 'result', 
-            'source' : remote.uuid,
-            'data': {
-              'id' : obj['id'], 
-              'result' : result
-            }
-          }
-        )
-        logging.debug('Result: ' + retstr)
-        remote.post(retstr)
-      else:
-        logging.warning('Unregistered mapping: ' + parts[0])
+          step()
+
+      step()
+      return batch
+
+    def batchResult(self, addrs, results):
+      ret = []
+      for i in range(len(addrs)):
+        entry = {"addr" : addrs[i]}
+        if i >= len(results):
+          entry["status"] = "skipped"
+        elif isinstance(results[i], Exception):
+          entry["status"] = "error"
+          entry["result"] = {"error" : "%s failed" % addrs[i]}
+        else:
+          entry["status"] = "error" if self.isFailure(results[i]) else "ok"
+          entry["result"] = results[i]
+        ret.append(entry)
+      return ret
 
-      measure = (time.time() - measure)*1000
-      logging.debug('Handle command took %dms', measure)
-      return
+    def handleCommand(self, remote, data):
+      debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+      if debug:
+        logging.debug('Contents: %s', data)
+        measure = time.time()
+      obj = json.loads(data)
+      what = obj.get('addr', 'batch')
+
+      try:
+        if 'batch' in obj:
+          result = self.executeBatch(obj['batch'], obj.get('continue', False))
+        else:
+          result = self.executeAddress(obj['addr'])
+      except Exception:
+        logging.exception('Failed to execute %s', what)
+        result = {"error" : "%s failed" % what}
+      if isinstance(result, Future):
+        # Post the result once the driver is done with it, failed or not
+        result.add_done_callback(lambda f: self.postResult(remote, obj['id'], self.futureResult(f, what)))
+      else:
+        self.postResult(remote, obj['id'], result)
+
+      if debug:
+        logging.debug('Handle command took %dms', (time.time() - measure)*1000)
+
+    def futureResult(self, future, what):
+      """Result of future, failures become an error like the REST end-points"""
+      if future.exception() is not None:
+        logging.error('%s failed: %r', what, future.exception())
+        return {"error" : "%s failed" % what}
+      return future.result()
+
+    def postResult(self, remote, id, result):
+      retstr = json.dumps(
+        {
+          'type' : 'result', 
+          'source' : remote.uuid,
+          'data': {
+            'id' : id, 
+            'result' : result
+          }
+        }
+      )
+      logging.debug('Result: %s', retstr)
+      remote.post(retstr, reply=True)
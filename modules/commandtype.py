@@ -28,6 +28,7 @@ class CommandType:
                       # will automatically be tracked and only one call comes
                       # through, ie:
                       # call1, call1, call1, call2, call1 -> call1, call2, call1
+                      # This is done by the router when it updates routes
   FLAG_RESULT     = 4 # This command will return a result
 
   """ Categories describing scenes in "one word"
@@ -22,6 +22,7 @@ should it be possible.
 Also able to reply back regarding state of various parts of the system
 """
 from .commandtype import CommandType
+from .executor import resolved, then
 import logging
 
 class Core:
@@ -32,7 +33,7 @@ class Core:
   ZONE_TABLE = None
   """
 
-  def __init__(self, setup, remotemgr):
+  def __init__(self, setup, remotemgr, executor):
     """
     At this point, initialize some extra parameters, such as the combined
     capabilties of zones which have sub-zones.
@@ -44,6 +45,8 @@ class Core:
     self.ZONE_TABLE     = setup['ZONE_TABLE']
     self.OPTIONS        = setup['OPTIONS']
     self.REMOTEMGR      = remotemgr
+    self.EXECUTOR       = executor
+    self.ROUTER         = None
 
     # Validate zone structure and provide good defaults
     for z in self.ZONE_TABLE:
@@ -63,6 +66,20 @@ class Core:
             self.ZONE_TABLE[z]["video"] = []
         self.ZONE_TABLE[z]["active-subzone"] = self.ZONE_TABLE[z]["subzone-default"]
 
+    # Routes may already have been compiled, see SetupParser.saveCache()
+    if 'ROUTES' in setup:
+      self.ROUTES = setup['ROUTES']
+      self.INCONCLUSIVE = setup['INCONCLUSIVE']
+    else:
+      self.compileRoutes()
+
+    # Active state per zone and the zones using each driver, kept up to date
+    # as scenes and subzones change (see updateZoneState)
+    self.ACTIVE = {}
+    self.OWNERS = {}
+
+    # Command catalogs, see getCommandCatalog()
+    self.COMMANDS = {}
 
   def hasScene(self, name):
     """Returns true if scene exists"""
@@ -120,9 +137,7 @@ class Core:
     result = []
     for z in self.ZONE_TABLE:
       if self.ZONE_TABLE[z]["active-scene"] == name:
-        for r in self.REMOTEMGR.list():
-          if self.REMOTEMGR.get(r, "active-zone") == z:
-            result.append(r)
+        result.extend(self.REMOTEMGR.getZoneRemotes(z))
     return result
 
   def getZoneList(self):
@@ -173,6 +188,7 @@ class Core:
       if self.ZONE_TABLE[zone]["active-subzone"] is None:
         self.ZONE_TABLE[zone]["active-subzone"] = self.ZONE_TABLE[zone]["subzone-default"]
 
+    self.updateActiveZone(zone)
     return True
 
   def getZoneScene(self, zone):
@@ -188,6 +204,7 @@ class Core:
       logging.error("%s is not a zone" % zone)
       return False
     self.ZONE_TABLE[zone]["active-scene"] = None
+    self.updateActiveZone(zone)
     return True
 
   def getSubZone(self, zone):
@@ -210,6 +227,7 @@ class Core:
       logging.error("%s does not have sub zone %s" % (zone, sub))
       return False
     self.ZONE_TABLE[zone]["active-subzone"] = sub
+    self.updateActiveZone(zone)
     return True
 
   def clearSubZone(self, zone):
@@ -218,6 +236,7 @@ class Core:
       logging.error("%s does not have subzones" % zone)
       return False
     self.ZONE_TABLE[zone]["active-subzone"] = self.getSubZoneDefault(zone)
+    self.updateActiveZone(zone)
     return True
 
   def getSubZoneList(self, zone):
@@ -256,7 +275,7 @@ class Core:
     if not self.hasZone(zone):
       logging.error("%s is not a zone" % zone)
       return False
-    self.REMOTEMGR.set(remote, "active-zone", zone)
+    self.REMOTEMGR.setZone(remote, zone)
     return True
 
   def getRemoteZone(self, name):
@@ -264,7 +283,7 @@ class Core:
     if not self.REMOTEMGR.has(name):
       logging.error("%s is not a remote" % name)
       return None
-    return self.REMOTEMGR.get(name, "active-zone")
+    return self.REMOTEMGR.getZone(name)
 
   def getZoneRemoteList(self, zone):
     """Gets a list of remotes currently controlling the zone"""
@@ -272,37 +291,97 @@ class Core:
       logging.error("%s is not a zone" % zone)
       return []
 
-    result = []
-    for r in self.REMOTEMGR.list():
-      if self.REMOTEMGR.get(r, "active-zone") == zone:
-        result.append(r)
-    return result
+    return self.REMOTEMGR.getZoneRemotes(zone)
 
   def clearRemoteZone(self, remote):
     if not self.REMOTEMGR.has(remote):
       logging.error("%s is not a remote" % remote)
       return False
-    self.REMOTEMGR.set(remote, "active-zone", None)
+    self.REMOTEMGR.setZone(remote, None)
     return True
 
   def getZoneCommands(self, zone):
-    result = {}
-    s = self.getZoneScene(zone)
-    if s is None:
-      return {}
-    s = self.getScene(s)
+    return self.getCommandCatalog(zone)["zone"]
+
+  def setRouter(self, router):
+    """
+    The router is created after core, it's told when remotes change state
+    it keeps track of (see execZoneCommand())
+    """
+    self.ROUTER = router
 
-    (adrv, vdrv) = self.getZoneDrivers(zone)
+  def invalidateCommands(self):
+    """
+    Drops all command catalogs, needed when a driver changes its commands.
+    Always replaces the set of catalogs rather than clearing it, see
+    getCommandCatalog().
+    """
+    self.COMMANDS = {}
 
-    adrv = self.getDriver(adrv)
-    vdrv = self.getDriver(vdrv)
+  def getCommandCatalog(self, zone):
+    """
+    Returns the commands available in a zone given its active scene and
+    subzone. The catalog is compiled on first use and then cached using
+    zone, scene and subzone as key, so any change of scene or subzone
+    selects a different entry.
+
+    Structure of return is:
+    {
+      "zone" : <same as getRemoteCommands()>,
+      "scene" : <same as getRemoteCommands()>,
+      "dispatch" : { "command" : (<driver>, <zone of driver>, <name in route>), ... },
+      "types" : { <CommandType> : "command", ... }
+    }
 
-    if adrv is not None and s["audio"]:
-      result.update(adrv.getCommands())
-    if vdrv is not None and s["video"]:
-      result.update(vdrv.getCommands())
+    The catalog is shared, callers must not change it.
+    """
+    # Drivers may invalidate the catalogs from their lane while we compile,
+    # in which case the result is stored in the old (discarded) set only
+    catalogs = self.COMMANDS
+    scene = self.ZONE_TABLE[zone]["active-scene"]
+    key = (zone, scene, self.ZONE_TABLE[zone]["active-subzone"])
+    if key in catalogs:
+      return catalogs[key]
+
+    catalog = {"zone" : {}, "scene" : {}, "dispatch" : {}, "types" : {}}
+    if scene is not None:
+      s = self.getScene(scene)
+      (adrv, vdrv) = self.getZoneDrivers(zone)
 
-    return result
+      # Audio driver takes precedence when executing, video when listing
+      for drv, enabled in [(vdrv, s["video"]), (adrv, s["audio"])]:
+        if drv is None or not enabled:
+          continue
+        name = drv
+        (drv, drvzone) = self.splitDriver(drv)
+        drv = self.getDriver(drv)
+        if drv is None:
+          continue
+        cmds = drv.getCommands()
+        for cmd in cmds:
+          catalog["dispatch"][cmd] = (drv, drvzone, name)
+          catalog["types"][cmds[cmd]["type"]] = cmd
+      for drv, enabled in [(adrv, s["audio"]), (vdrv, s["video"])]:
+        drv = self.getDriver(drv)
+        if drv is not None and enabled:
+          catalog["zone"].update(drv.getCommands())
+
+      catalog["scene"] = self.getSceneCommands(scene)
+
+    catalogs[key] = catalog
+    return catalog
+
+  def getZoneCommandByType(self, zone, cmdtype):
+    """
+    Finds the zone command of the given CommandType in the zone's
+    current scene. Returns (command, driver, zone of driver) or None
+    """
+    catalog = self.getCommandCatalog(zone)
+    if cmdtype not in catalog["types"]:
+      return None
+    cmd = catalog["types"][cmdtype]
+    (drv, drvzone, name) = catalog["dispatch"][cmd]
+    return (cmd, drv, drvzone)
 
   def getSceneCommands(self, scene):
     if not self.hasScene(scene):
@@ -350,61 +429,60 @@ class Core:
       return result
 
     zname = self.getRemoteZone(remote)
-    sname = self.getZoneScene(zname)
-    if sname is None:
+    if self.getZoneScene(zname) is None:
       logging.warn("Zone %s is not assigned a scene" % zname)
-      #return []
 
-    result["zone"] = self.getZoneCommands(zname)
-    result["scene"] = self.getSceneCommands(sname)
+    catalog = self.getCommandCatalog(zname)
+
+    result["zone"] = catalog["zone"]
+    result["scene"] = catalog["scene"]
 
     return result
 
   def execZoneCommand(self, remote, command, extras):
+    """
+    Queues the command on the driver handling it, returns a future
+    holding the result of the command.
+    """
     if not self.REMOTEMGR.has(remote):
       logging.error("%s is not a remote" % remote)
-      return False
+      return resolved(False)
     zone = self.getRemoteZone(remote)
-    scene = self.getZoneScene(zone)
-    if scene is None:
-      return False
-    scene = self.getScene(scene)
-
-    (adrv, vdrv) = self.getZoneDrivers(zone)
-    if adrv is not None:
-      (adrv, az) = self.splitDriver(adrv)
-    if vdrv is not None:
-      (vdrv, vz) = self.splitDriver(vdrv)
-    adrv = self.getDriver(adrv)
-    vdrv = self.getDriver(vdrv)
+    if zone is None:
+      return resolved(False)
 
-    if adrv is not None and scene["audio"]:
-      if command in adrv.getCommands():
-        return adrv.handleCommand(az, command, extras)
-    if vdrv is not None and scene["video"]:
-      if command in vdrv.getCommands():
-        return vdrv.handleCommand(vz, command, extras)
+    dispatch = self.getCommandCatalog(zone)["dispatch"]
+    if command not in dispatch:
+      return resolved(False)
 
-    return False
+    (drv, drvzone, name) = dispatch[command]
+    # Router keeps track of these, make it send them again on the next route change
+    if self.ROUTER is not None and drv.getCommandGroup(command) is not None:
+      self.ROUTER.forgetState(name)
+    return self.EXECUTOR.submit(drv, drv.handleCommand, drvzone, command, extras)
 
   def execSceneCommand(self, remote, command, extras):
+    """
+    Queues the command on the scene driver, returns a future
+    holding the result of the command.
+    """
     logging.debug("execSceneCommand called")
     if not self.REMOTEMGR.has(remote):
       logging.error("%s is not a remote" % remote)
-      return False
+      return resolved(False)
     zone = self.getRemoteZone(remote)
     scene = self.getZoneScene(zone)
     if scene is None:
-      return False
+      return resolved(False)
     scene = self.getScene(scene)
 
     drv = self.getDriver(scene["driver"])
-    if command in drv.getCommands():
-      return drv.handleCommand(None, command, extras)
+    if command in self.getCommandCatalog(zone)["scene"]:
+      return self.EXECUTOR.submit(drv, drv.handleCommand, None, command, extras)
     else:
       logging.warning("%s is not a command" % command)
 
-    return False
+    return resolved(False)
 
 
   def getZoneDrivers(self, zone):
@@ -428,7 +506,7 @@ class Core:
     """
     Shows the current state which indicates what's going on.
     Format:
-    {<zone> : [<driver> : { "commands" : [<command>, ...], "extras" : <string>}, ...], ...}
+    {<zone> : {"route" : {<driver> : [<command>, ...], ...}, "scene" : <scene>, "extras" : {<driver> : <string>}}, ...}
 
     Some examples...
     PS4 is playing in Zone1 and Spotify in Zone2:
@@ -454,20 +532,47 @@ class Core:
     result = {}
 
     for z in self.ZONE_TABLE:
-      route = self.getCurrentRouteForZone(z)
-      scene = self.getScene(self.getZoneScene(z))
-      if not route is None:
-        result[z] = {"route" : route}
-        if scene is not None and "driver-extras" in scene:
-          result[z]["extras"] = {scene["driver"] : scene["driver-extras"]}
+      if z in self.ACTIVE:
+        result[z] = self.ACTIVE[z]
 
     return result
 
+  def updateActiveZone(self, zone):
+    """
+    Refreshes the active state of a zone along with the index of which
+    zones use what drivers. Must be called whenever the scene or subzone
+    of a zone changes.
+    """
+    old = self.ACTIVE.pop(zone, None)
+    if old is not None:
+      for d in old["route"]:
+        self.OWNERS[d].discard(zone)
+        if len(self.OWNERS[d]) == 0:
+          del self.OWNERS[d]
+
+    route = self.getCurrentRouteForZone(zone)
+    if route is None:
+      return
+
+    scene = self.getZoneScene(zone)
+    state = {"route" : route, "scene" : scene}
+    if "driver-extras" in self.SCENE_TABLE[scene]:
+      state["extras"] = {self.SCENE_TABLE[scene]["driver"] : self.SCENE_TABLE[scene]["driver-extras"]}
+    self.ACTIVE[zone] = state
+
+    for d in route:
+      if d not in self.OWNERS:
+        self.OWNERS[d] = set()
+      self.OWNERS[d].add(zone)
+
   def getCurrentRouteForZone(self, zone, subzone=None, sceneOverride=None):
     """
     Obtains a route for a zone based on active scene and potentially subzone.
     If provided with a sceneOverride, the active scene is ignored and the
     provided scene will be used instead.
+
+    All routes are compiled by compileRoutes() when loading, so this is
+    a simple lookup.
     """
     if not self.hasZone(zone):
       logging.error("%s is not a zone" % zone)
@@ -483,54 +588,79 @@ class Core:
     else:
       s = sceneOverride
 
-    if sceneOverride is None:
-      (adrv, vdrv) = self.getZoneDrivers(zone)
-    else:
-      # We need to perform an acrobatics act here since we
-      # must resolve drivers without actually assigning them
-      if self.hasSubZones(zone):
-        if subzone is None:
-          sz = self.ZONE_TABLE[zone]["active-subzone"]
-          if sz is None:
-            sz = self.ZONE_TABLE[zone]["subzone-default"]
-        else:
-          sz = subzone
-        adrv = self.ZONE_TABLE[zone]["subzones"][sz]["audio"]
-        vdrv = self.ZONE_TABLE[zone]["subzones"][sz]["video"]
+    sz = None
+    if self.hasSubZones(zone):
+      if subzone is None or sceneOverride is None:
+        sz = self.ZONE_TABLE[zone]["active-subzone"]
+        if sz is None:
+          sz = self.ZONE_TABLE[zone]["subzone-default"]
       else:
-        adrv = self.ZONE_TABLE[zone]["audio"]
-        vdrv = self.ZONE_TABLE[zone]["video"]
-
-    sdrv = self.SCENE_TABLE[s]["driver"]
+        sz = subzone
 
-    # Translate into route
-    if "driver-extras" in self.SCENE_TABLE[s]:
-      extras = self.SCENE_TABLE[s]["driver-extras"]
-    else:
-      extras = None
+    route = self.ROUTES.get((zone, sz, s), None)
+    if route is None:
+      logging.error("There is no route for scene %s in zone %s" % (s, zone))
+    return route
 
-    if self.SCENE_TABLE[s]["audio"] and not self.SCENE_TABLE[s]["video"]:
-      route = self.resolveRoute(sdrv, adrv, None)
-    elif self.SCENE_TABLE[s]["audio"] and self.SCENE_TABLE[s]["video"]:
-      route = self.resolveRoute(sdrv, adrv, vdrv)
-    elif not self.SCENE_TABLE[s]["audio"] and self.SCENE_TABLE[s]["video"]:
+  def compileRoutes(self):
+    """
+    Resolves the route of every scene in every zone (and subzone) so that
+    getCurrentRouteForZone() doesn't have to. Combinations which cannot be
+    routed are left out, combinations which have more than one possible
+    route are listed in INCONCLUSIVE (and use the first route).
+    """
+    self.ROUTES = {}
+    self.INCONCLUSIVE = []
+    for z in self.ZONE_TABLE:
+      if self.hasSubZones(z):
+        subzones = self.ZONE_TABLE[z]["subzones"]
+      else:
+        subzones = [None]
+      for sz in subzones:
+        if sz is None:
+          adrv = self.ZONE_TABLE[z]["audio"]
+          vdrv = self.ZONE_TABLE[z]["video"]
+        else:
+          adrv = self.ZONE_TABLE[z]["subzones"][sz]["audio"]
+          vdrv = self.ZONE_TABLE[z]["subzones"][sz]["video"]
+        # Every scene, since scenes the zone doesn't list may still be assigned
+        for s in self.SCENE_TABLE:
+          routes = self.resolveRoute(s, adrv, vdrv)
+          if len(routes) == 0:
+            logging.warning("Scene %s cannot be routed in zone %s (subzone %s)" % (s, z, sz))
+            continue
+          if len(routes) > 1:
+            logging.warning("Routing of scene %s in zone %s (subzone %s) is inconclusive, got %d routes" % (s, z, sz, len(routes)))
+            self.INCONCLUSIVE.append({"zone" : z, "subzone" : sz, "scene" : s, "routes" : len(routes)})
+          self.ROUTES[(z, sz, s)] = self.translateRoute(routes[0], adrv, vdrv)
+
+  def getInconclusiveRoutes(self):
+    """Lists the zone/subzone/scene combinations which had more than one route"""
+    return self.INCONCLUSIVE
+
+  def resolveRoute(self, scene, adrv, vdrv):
+    """
+    Resolves the possible routes needed for a scene given the audio and
+    optionally video driver. Returns an empty list if scene cannot be routed.
+    """
+    sdrv = self.SCENE_TABLE[scene]["driver"]
+    if self.SCENE_TABLE[scene]["audio"] and not self.SCENE_TABLE[scene]["video"]:
+      vdrv = None
+    elif not self.SCENE_TABLE[scene]["audio"] and self.SCENE_TABLE[scene]["video"]:
       logging.error("Video only zones are not supported")
-    else:
+      return []
+    elif not self.SCENE_TABLE[scene]["audio"]:
       logging.error("Scene has neither audio nor video!")
+      return []
 
-    return self.translateRoute(zone, route)
-
-  def resolveRoute(self, sdrv, adrv, vdrv):
-    """
-    Resolves the routing needed for a scene driver with audio and
-    optionally video driver.
-    """
     if sdrv not in self.ROUTING_TABLE:
       logging.error("%s does not have any routing information" % sdrv)
       return []
+    if adrv is None:
+      return []
 
     if vdrv == None or not "audio+video" in self.ROUTING_TABLE[sdrv]:
-      baseRoutes = self.ROUTING_TABLE[sdrv]["audio"]
+      baseRoutes = self.ROUTING_TABLE[sdrv].get("audio", [])
     else:
       baseRoutes = self.ROUTING_TABLE[sdrv]["audio+video"]
 
@@ -538,13 +668,13 @@ class Core:
     if not vdrv is None:
       routes = self.filterRoutes(routes, vdrv)
 
-    if len(routes) != 1:
-      logging.warning("Routing was inconclusive, got %d routes" % len(routes))
-
-    route = routes[0]
-    if not sdrv in route:
-      route[sdrv] = []
-    return route
+    result = []
+    for route in routes:
+      route = dict(route)
+      if not sdrv in route:
+        route[sdrv] = []
+      result.append(route)
+    return result
 
   def filterRoutes(self, routes, drv):
     """
@@ -581,12 +711,11 @@ class Core:
     else:
       return (ret[0], ret[1])
 
-  def translateRoute(self, zone, route):
+  def translateRoute(self, route, adrv, vdrv):
     """
-    Takes a route and adjusts drivers based on zone, this is needed since some
-    drivers support segmentation.
+    Takes a route and adjusts drivers based on the zone's audio and video
+    driver, this is needed since some drivers support segmentation.
     """
-    (adrv, vdrv) = self.getZoneDrivers(zone)
     if not adrv is None:
       (adrv, aext) = self.translateDriver(adrv)
     else:
@@ -630,29 +759,23 @@ class Core:
     which would be impacted if there is a conflict.
     """
 
-    # Get current state and remove our zone
-    active = self.getCurrentState()
-    active.pop(zone, None)
-
-    if len(active) == 0:
+    # Generate a route based on provided information
+    route = self.getCurrentRouteForZone(zone, None, scene)
+    if route is None:
       return None
 
-    # Now, generate a route based on provided information
-    route = self.getCurrentRouteForZone(zone, None, scene)
+    # Find any other zone using the same drivers
+    impacted = set()
+    for d in route:
+      if d in self.OWNERS:
+        impacted.update(self.OWNERS[d])
+    impacted.discard(zone)
 
-    # Find any overlap of drivers
-    result = []
-    for z in active:
-      logging.debug("Checking zone " + z)
-      for d in active[z]["route"]:
-        if d in route:
-          logging.warning("Overlap detected, %s is already in use")
-          result.append(z)
-          break
+    if len(impacted) == 0:
+      return None
 
-    if len(result) > 0:
-      return result
-    return None
+    logging.debug("Overlap detected with zone(s) %s" % repr(impacted))
+    return [z for z in self.ZONE_TABLE if z in impacted]
 
   def getDriver(self, driver):
     if driver is None:
@@ -676,11 +799,14 @@ class Core:
       return pin == self.OPTIONS["pin-remote"]
 
   def updateZoneState(self, zone, remote):
-    ret = {}
-    # Uses the event manager to send relevant state information to the remote
-    data = self.execZoneCommand(remote, 'volume-get', None)
-    logging.debug('updateZoneState: ' + repr(data))
-    if data and 'volume' in data:
-      ret['volume'] = data['volume']
-    return ret
-      
\ No newline at end of file
+    """
+    Collects relevant state information for the zone, returns a future
+    since this involves asking the drivers.
+    """
+    def process(data):
+      ret = {}
+      logging.debug('updateZoneState: ' + repr(data))
+      if data and 'volume' in data:
+        ret['volume'] = data['volume']
+      return ret
+    return then(self.execZoneCommand(remote, 'volume-get', None), process)
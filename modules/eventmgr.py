@@ -2,37 +2,139 @@ import threading
 import queue
 import time
 import logging
+import json
+import collections
 
-from tornado.ioloop import IOLoop
+from tornado.websocket import WebSocketClosedError
 
 class EventHandler:
   class Remote():
-    def __init__(self, websocket, uuid, funcPost):
+    """
+    A connected websocket. Messages are queued per remote and written one
+    at a time on the IOLoop, so a slow remote can't make Tornado buffer
+    an unbounded backlog.
+
+    Messages posted with a key replace any queued message with the same
+    key (latest wins). If the queue is full, the oldest event is dropped.
+    Replies are never dropped, the client is waiting for them. A remote whose oldest queued message is older than
+    LAG_LIMIT seconds is disconnected.
+    """
+    QUEUE_LIMIT = 100
+    LAG_LIMIT = 10
+
+    def __init__(self, websocket, uuid, funcSchedule):
       self.socket = websocket
       self.uuid = uuid
       self.subscriptions = []
-      self.funcPost = funcPost
+      self.funcSchedule = funcSchedule
+      self.lock = threading.Lock()
+      self.queue = collections.deque() # entries are [key, message, queued at, reply]
+      self.keyed = {} # key -> queued entry
+      self.sending = False
+      self.closed = False
+      self.sent = 0
+      self.dropped = 0
+      self.coalesced = 0
 
     def subscribe(self, topic):
+      """Returns the normalized topic if it's new, otherwise None"""
       topic = topic.strip().lower()
       if not topic or topic in self.subscriptions:
-        return
+        return None
       self.subscriptions.append(topic)
+      return topic
+
+    def post(self, message, key=None, reply=False):
+      """
+      Queues message for delivery, may be called from any thread. Set
+      reply for answers to requests from the remote, see class description.
+      """
+      with self.lock:
+        if self.closed:
+          return
+        if key is not None and key in self.keyed:
+          self.keyed[key][1] = message
+          self.coalesced += 1
+          return
+        if self.queue and time.time() - self.queue[0][2] > EventHandler.Remote.LAG_LIMIT:
+          logging.warning('Remote %s is lagging behind with %d messages, disconnecting', self.uuid, len(self.queue))
+          self.drain()
+          self.funcSchedule(self.socket.close)
+          return
+        if len(self.queue) >= EventHandler.Remote.QUEUE_LIMIT:
+          oldest = next((i for i, e in enumerate(self.queue) if not e[3]), None)
+          if oldest is not None:
+            self.forget(self.queue[oldest])
+            del self.queue[oldest]
+            self.dropped += 1
+          elif not reply:
+            # Nothing but replies queued, this event is the one to go
+            self.dropped += 1
+            return
+        entry = [key, message, time.time(), reply]
+        self.queue.append(entry)
+        if key is not None:
+          self.keyed[key] = entry
+        if self.sending:
+          return
+        self.sending = True
+      self.funcSchedule(self.flush)
+
+    def forget(self, entry):
+      if entry[0] is not None and self.keyed.get(entry[0]) is entry:
+        del self.keyed[entry[0]]
+
+    def drain(self):
+      """Called with lock held, discards everything queued"""
+      self.closed = True
+      self.queue.clear()
+      self.keyed.clear()
+
+    async def flush(self):
+      """Runs on the IOLoop, writes queued messages one at a time"""
+      while True:
+        with self.lock:
+          if not self.queue or self.closed:
+            self.sending = False
+            return
+          entry = self.queue.popleft()
+          self.forget(entry)
+        try:
+          await self.socket.write_message(entry[1])
+          self.sent += 1
+        except WebSocketClosedError:
+          with self.lock:
+            self.drain()
+            self.sending = False
+          return
 
-    def post(self, message):
-      self.funcPost(message)
-      #IOLoop.instance().add_callback(callback=self.socket.write_message, args=message)
-     
-      #self.socket.write_message(message)
+    def close(self):
+      with self.lock:
+        self.drain()
+
+    def getStatus(self):
+      return {
+        "depth" : len(self.queue),
+        "sent" : self.sent,
+        "dropped" : self.dropped,
+        "coalesced" : self.coalesced,
+      }
 
   def __init__(self, core):
     self.remotes = []
+    self.connected = {} # uuid -> remotes, since a remote may connect more than once
     self.core = core
     self.commands = {}
+    self.topics = {} # topic -> set of subscribed remotes
+    self.lock = threading.Lock() # Drivers may send events from their own lane, guards remotes, connected and topics
 
   def addRemote(self, remote):
     logging.info('Remote %s has connected', remote.uuid)
-    self.remotes.append(remote)
+    with self.lock:
+      self.remotes.append(remote)
+      if remote.uuid not in self.connected:
+        self.connected[remote.uuid] = []
+      self.connected[remote.uuid].append(remote)
   
   def removeRemote(self, remote=None, uuid=None, socket=None):
     if not remote:
@@ -43,22 +145,35 @@ class EventHandler:
       return
 
     logging.info('Remote %s has disconnected', remote.uuid)
-    self.remotes.remove(remote)
+    remote.close()
+    with self.lock:
+      for topic in remote.subscriptions:
+        self.topics[topic].discard(remote)
+        if len(self.topics[topic]) == 0:
+          del self.topics[topic]
+      self.remotes.remove(remote)
+      self.connected[remote.uuid].remove(remote)
+      if len(self.connected[remote.uuid]) == 0:
+        del self.connected[remote.uuid]
 
   def hasRemote(self, uuid):
-    for remote in self.remotes:
-      if remote.uuid == uuid:
-        return True
-    return False
+    with self.lock:
+      return uuid in self.connected
 
   def getRemote(self, uuid=None, socket=None):
-    for remote in self.remotes:
-      if uuid and remote.uuid == uuid:
-        return remote
-      elif socket and remote.socket == socket:
-        return remote
+    with self.lock:
+      if uuid and uuid in self.connected:
+        return self.connected[uuid][0]
+      for remote in self.remotes:
+        if socket and remote.socket == socket:
+          return remote
     return None
 
+  def getRemoteList(self):
+    """Returns a copy of the connected remotes, safe to use from any thread"""
+    with self.lock:
+      return list(self.remotes)
+
   def handleMessage(self, socket, message):
     remote = self.getRemote(socket=socket)
     if not remote:
@@ -72,20 +187,106 @@ class EventHandler:
     if command == 'LOG':
       logging.debug('%s DEBUG: %s', remote.uuid, data)
     elif command == 'SUBSCRIBE':
-      remote.subscribe(data)
+      self.subscribe(remote, data)
     else:
       if command.upper() in self.commands:
         self.commands[command.upper()](remote, data)
       else:
         logging.debug("%s sent unknown message: %s", remote.uuid, message)
 
-  def notify(self, zone, message):
-    for remote in self.remotes:
-      if zone is None or self.core.getRemoteZone(remote.uuid) == zone:
-        logging.info("Informing remote %s about \"%s\"", remote.uuid, message)
-        remote.post(message)
-      else:
-        logging.info("Skipped remote %s", remote.uuid)
+  def getZoneRemotes(self, zone):
+    """
+    Returns the connected remotes attached to zone, or all connected
+    remotes if zone is None
+    """
+    if zone is None:
+      return self.getRemoteList()
+    remotes = []
+    uuids = self.core.getZoneRemoteList(zone)
+    with self.lock:
+      for uuid in uuids:
+        remotes.extend(self.connected.get(uuid, []))
+    return remotes
+
+  def subscribe(self, remote, topic):
+    topic = remote.subscribe(topic)
+    if topic is None:
+      return
+    logging.debug('Remote %s subscribed to %s', remote.uuid, topic)
+    with self.lock:
+      if topic not in self.topics:
+        self.topics[topic] = set()
+      self.topics[topic].add(remote)
+
+  def getTopics(self):
+    """Returns the subscribed topics and which remotes subscribed to them"""
+    with self.lock:
+      return {topic: sorted(r.uuid for r in remotes) for topic, remotes in self.topics.items()}
+
+  def getSubscribers(self, topics):
+    """
+    Returns the set of remotes subscribed to any of the topics. A topic
+    such as "driver.receiver" is matched by the subscriptions
+    "driver.receiver", "driver.*" and "*".
+    """
+    keys = ['*']
+    for topic in topics:
+      keys.append(topic)
+      parts = topic.split('.')
+      for i in range(1, len(parts) + 1):
+        keys.append('.'.join(parts[:i]) + '.*')
+
+    ret = set()
+    with self.lock:
+      for key in keys:
+        if key in self.topics:
+          ret.update(self.topics[key])
+    return ret
+
+  def notify(self, zone, message, driver=None):
+    """
+    Sends message to all remotes attached to zone (or all remotes if zone
+    is None). The message is encoded once and the same frame is posted
+    to every remote.
+
+    Remotes which have subscribed to topics only get the message if it
+    matches one of them. The topics of a message are its type and, when
+    sent by a driver, "driver.<name>". Remotes without subscriptions get
+    everything.
+    """
+    remotes = self.getZoneRemotes(zone)
+    if not remotes:
+      return
+
+    # Subscriptions are lowercase (see Remote.subscribe()) while device names may not be
+    topics = [message["type"].lower()]
+    if driver is not None:
+      topics.append(('driver.%s' % driver).lower())
+    subscribers = self.getSubscribers(topics)
+    remotes = [r for r in remotes if not r.subscriptions or r in subscribers]
+    if not remotes:
+      return
+    frame = json.dumps(message)
+    key = self.getCoalesceKey(message)
+    logging.debug('Informing %d remote(s) about %s event in zone %s', len(remotes), message.get("type"), zone)
+    for remote in remotes:
+      remote.post(frame, key)
+
+  def getCoalesceKey(self, message):
+    """
+    State events for the same zone and the same keys replace each other
+    while queued, since only the latest value matters.
+    """
+    if message.get("type") != "state" or not isinstance(message.get("data"), dict):
+      return None
+    data = message["data"]
+    return 'state/%s/%s' % (data.get("zone"), ','.join(sorted(k for k in data if k != "zone")))
+
+  def getStatus(self):
+    ret = {}
+    for remote in self.getRemoteList():
+      ret[remote.uuid] = remote.getStatus()
+    return ret
 
   def registerCommand(self, command, funcHandler):
     '''
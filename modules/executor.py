@@ -0,0 +1,177 @@
+# This file is part of multiRemote.
+#
+# multiRemote is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# multiRemote is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with multiRemote.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Executes calls into drivers.
+
+Each driver gets a lane, which is a thread with its own queue, so that
+commands to the same device always execute in the order they were issued
+while commands to independent devices run at the same time.
+
+Drivers which report isAsync() as False cannot have multiple instances
+in use at the same time, so all instances of such a driver share one lane.
+
+All calls return a concurrent.futures.Future which holds the result.
+"""
+from concurrent.futures import Future
+import threading
+import queue
+import logging
+
+def resolved(value):
+  """Returns a future which already holds value"""
+  future = Future()
+  future.set_result(value)
+  return future
+
+def then(future, func):
+  """
+  Returns a new future which holds the result of func() applied on the
+  result of the provided future. func() is called on whatever thread
+  completes the provided future.
+  """
+  result = Future()
+  def done(f):
+    try:
+      result.set_result(func(f.result()))
+    except Exception as e:
+      logging.exception('Failed to process result')
+      result.set_exception(e)
+  future.add_done_callback(done)
+  return result
+
+def gather(values):
+  """
+  Returns a future which holds a list with the results of values, once
+  all of them are done. values may mix futures and plain values. A future
+  which failed is represented by its exception in the list.
+  """
+  result = Future()
+  values = list(values)
+  futures = [v for v in values if isinstance(v, Future)]
+  remaining = [len(futures)]
+  lock = threading.Lock()
+
+  def complete():
+    ret = []
+    for v in values:
+      if not isinstance(v, Future):
+        ret.append(v)
+      elif v.exception() is not None:
+        ret.append(v.exception())
+      else:
+        ret.append(v.result())
+    result.set_result(ret)
+
+  def done(f):
+    with lock:
+      remaining[0] -= 1
+      last = remaining[0] == 0
+    if last:
+      complete()
+
+  if not futures:
+    complete()
+  for f in futures:
+    f.add_done_callback(done)
+  return result
+
+class Worker(threading.Thread):
+  """
+  A thread with its own queue, executing the submitted tasks one at a
+  time in the order they were submitted
+  """
+  def __init__(self, name):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.name = name
+    self.queue = queue.Queue()
+    self.busy = False
+    self.processed = 0
+    self.start()
+
+  def submit(self, task, *args):
+    future = Future()
+    self.queue.put_nowait((future, task, args))
+    return future
+
+  def depth(self):
+    """Number of calls which are queued or executing"""
+    return self.queue.qsize() + (1 if self.busy else 0)
+
+  def run(self):
+    while True:
+      future, task, args = self.queue.get()
+      if not future.set_running_or_notify_cancel():
+        continue
+      self.busy = True
+      try:
+        future.set_result(task(*args))
+      except Exception as e:
+        logging.exception('%s failed to execute %s', self.name, repr(task))
+        future.set_exception(e)
+      finally:
+        self.busy = False
+        self.processed += 1
+
+class DriverExecutor:
+  class Lane(Worker):
+    """A worker running the calls of one or more drivers"""
+    def __init__(self, name):
+      self.drivers = []
+      Worker.__init__(self, 'lane-%s' % name)
+
+  def __init__(self):
+    self.lanes = {}
+    self.driverLane = {}
+    self.lock = threading.Lock()
+
+  def addDriver(self, name, driver):
+    """
+    Assigns a lane to the driver, async drivers get a lane of their own
+    while others share a lane with all instances of the same driver.
+    """
+    if driver.isAsync():
+      key = name
+    else:
+      key = driver.__class__.__name__
+    with self.lock:
+      if key not in self.lanes:
+        self.lanes[key] = DriverExecutor.Lane(key)
+      if name not in self.lanes[key].drivers: # Replaced drivers keep their name
+        self.lanes[key].drivers.append(name)
+      self.driverLane[id(driver)] = self.lanes[key]
+    return self.lanes[key]
+
+  def getLane(self, driver):
+    lane = self.driverLane.get(id(driver), None)
+    if lane is None:
+      logging.warning('%s was never added, giving it a lane', repr(driver))
+      lane = self.addDriver(repr(driver), driver)
+    return lane
+
+  def submit(self, driver, task, *args):
+    """Queues task on the lane of the driver, returns a future"""
+    return self.getLane(driver).submit(task, *args)
+
+  def getStatus(self):
+    ret = {}
+    for key, lane in self.lanes.items():
+      ret[key] = {
+        "drivers" : lane.drivers,
+        "depth" : lane.depth(),
+        "processed" : lane.processed,
+      }
+    return ret
@@ -1,46 +1,95 @@
 import re
-import importlib
+import os
+import copy
+import json
+import hashlib
 import logging
 
+from modules.registry import DriverRegistry
+
+def compileGrammar(patterns):
+  """
+  Compiles a list of (pattern, value) into the form used by
+  SetupParser.findEntry(), patterns are tried in the order given
+  """
+  return [(re.compile('^' + pattern + '$', re.DOTALL|re.IGNORECASE), value) for pattern, value in patterns]
+
 class SetupParser:
-  def __init__(self):
-    pass
+  # The grammar is compiled once, each section lists the lines it accepts
+  GRAMMAR = {
+    'sections' : compileGrammar([
+      ('options', 'options'),
+      ('device [a-zA-Z0-9]+', 'device'),
+      ('scene [a-zA-Z0-9]+ ?: ?.+', 'scene'),
+      ('zone [a-zA-Z0-9]+ ?: ?.+', 'zone'),
+    ]),
+    'options' : compileGrammar([
+      ('options', 'options'),
+      ('remote pin ([0-9]+)', 'pin'),
+      ('ux server (https?://[a-zA-Z\.:0-9\-/]+)', 'ux'),
+      ('volume ramp rate ([1-9][0-9]*)', 'ramp-rate'),
+      ('volume ramp step ([1-9][0-9]*)', 'ramp-step'),
+    ]),
+    'device' : compileGrammar([
+      ('device ([a-zA-Z0-9]+)', 'device'),
+      ('has ([1-9][0-9]*) zones', 'zones'),
+      ('uses driver ([a-zA-Z0-9]+)', 'uses-noargs'),
+      ('uses driver ([a-zA-Z0-9]+) with options (.*)', 'uses-args'),
+      ('path (audio|video|audio\+video|video\+audio) requires (.+)', 'path'),
+    ]),
+    'scene' : compileGrammar([
+      ('scene ([a-zA-Z0-9]+) ?: ?(.+)', 'name'),
+      ('uses device ([a-zA-Z0-9]+)', 'uses-noargs'),
+      ('uses device ([a-zA-Z0-9]+) with options (.*)', 'uses-args'),
+      ('described as (.+)', 'desc'),
+      ('requires (audio|video|video\+audio|audio\+video)', 'requires'),
+      ('hint ux (.+)', 'hint'),
+    ]),
+    'zone' : compileGrammar([
+      ('zone ([a-zA-Z0-9]+) ?: ?(.+)', 'zone'),
+      ('subzone ([a-zA-Z0-9]+) ?: ?(.+)', 'subzone'),
+      ('default subzone ([a-zA-Z0-9]+)', 'subzone-def'),
+      ('audio uses ([a-zA-Z0-9]+)', 'audio-noargs'),
+      ('audio uses ([a-zA-Z0-9]+) zone ([1-9][0-9]*)', 'audio-args'),
+      ('video uses ([a-zA-Z0-9]+)', 'video-noargs'),
+      ('video uses ([a-zA-Z0-9]+) zone ([1-9][0-9]*)', 'video-args'),
+      ('hint ux (.+)', 'hint'),
+    ]),
+  }
+  PATH_ARGUMENTS = re.compile('''([a-zA-Z0-9]+) *(?:\(([a-zA-Z0-9,\- ]+)\)|()),?''')
+  PATH_SEPARATOR = re.compile(' *, *')
+  STRING_ARGUMENTS = re.compile('''(?:"([^"]+)"|'([^']+)'|([^,]+)),? ?''')
+
+  # Bump whenever the layout of the compiled configuration changes
+  CACHE_VERSION = 2
+
+  def __init__(self, registry=None):
+    self.registry = registry if registry is not None else DriverRegistry()
+    self.compiled = None
 
   def handleOptions(self, config, line, temp):
-    valid = {
-      'options' : 'options',
-      'remote pin ([0-9]+)' : 'pin',
-      'ux server (https?://[a-zA-Z\.:0-9\-/]+)' : 'ux',
-    }
-    result = self.findEntry(line, valid)
+    result = self.findEntry(line, SetupParser.GRAMMAR['options'])
     if result is None:
       return False
-    (key, m) = result
-    value = valid[key]
+    (value, m) = result
     if value == 'options':
       pass
     elif value == 'pin':
       config['OPTIONS']['pin-remote'] = m[0]
     elif value == 'ux':
       config['OPTIONS']['ux-server'] = m[0]
+    elif value in ['ramp-rate', 'ramp-step']:
+      config['OPTIONS'][value] = int(m[0])
     else:
       return False
 
     return True
 
   def handleDevice(self, config, line, temp):
-    valid = {
-      'device ([a-zA-Z0-9]+)' : 'device',
-      'has ([1-9][0-9]*) zones' : 'zones',
-      'uses driver ([a-zA-Z0-9]+)' : 'uses-noargs',
-      'uses driver ([a-zA-Z0-9]+) with options (.*)' : 'uses-args',
-      'path (audio|video|audio\+video|video\+audio) requires (.+)' : 'path'
-    }
-    result = self.findEntry(line, valid)
+    result = self.findEntry(line, SetupParser.GRAMMAR['device'])
     if result is None:
       return False
-    (key, m) = result
-    value = valid[key]
+    (value, m) = result
     if value == 'device':
       temp['device'] = {'name' : m[0]}
       #config['DRIVER_TABLE'][temp['device']['name']] = None
@@ -65,19 +114,10 @@ class SetupParser:
     return True
 
   def handleScene(self, config, line, temp):
-    valid = {
-      'scene ([a-zA-Z0-9]+) ?: ?(.+)' : 'name',
-      'uses device ([a-zA-Z0-9]+)' : 'uses-noargs',
-      'uses device ([a-zA-Z0-9]+) with options (.*)' : 'uses-args',
-      'described as (.+)' : 'desc',
-      'requires (audio|video|video\+audio|audio\+video)' : 'requires',
-      'hint ux (.+)' : 'hint'
-    }
-    result = self.findEntry(line, valid)
+    result = self.findEntry(line, SetupParser.GRAMMAR['scene'])
     if result is None:
       return False
-    (key, m) = result
-    value = valid[key]
+    (value, m) = result
     if value == "name":
       temp['scene'] = {'name' : m[0]}
       config['SCENE_TABLE'][temp['scene']['name']] = {'name' : m[1]}
@@ -107,21 +147,10 @@ class SetupParser:
     return True
 
   def handleZone(self, config, line, temp):
-    valid = {
-      'zone ([a-zA-Z0-9]+) ?: ?(.+)' : 'zone',
-      'subzone ([a-zA-Z0-9]+) ?: ?(.+)' : 'subzone',
-      'default subzone ([a-zA-Z0-9]+)' : 'subzone-def',
-      'audio uses ([a-zA-Z0-9]+)' : 'audio-noargs',
-      'audio uses ([a-zA-Z0-9]+) zone ([1-9][0-9]*)' : 'audio-args',
-      'video uses ([a-zA-Z0-9]+)' : 'video-noargs',
-      'video uses ([a-zA-Z0-9]+) zone ([1-9][0-9]*)' : 'video-args',
-      'hint ux (.+)' : 'hint'
-    }
-    result = self.findEntry(line, valid)
+    result = self.findEntry(line, SetupParser.GRAMMAR['zone'])
     if result is None:
       return False
-    (key, m) = result
-    value = valid[key]
+    (value, m) = result
     if value == "zone":
       temp['zone'] = {'name':m[0]}
       config['ZONE_TABLE'][temp['zone']['name']] = {'name' : m[1]}
@@ -166,10 +195,9 @@ class SetupParser:
 
   def parsePathArguments(self, args):
     result = {}
-    p = re.compile('''([a-zA-Z0-9]+) *(?:\(([a-zA-Z0-9,\- ]+)\)|()),?''')
-    m = p.findall(args)
+    m = SetupParser.PATH_ARGUMENTS.findall(args)
     for n in m:
-      tmp = re.split(' *, *', n[1].strip())
+      tmp = SetupParser.PATH_SEPARATOR.split(n[1].strip())
       if tmp[0] == "":
         tmp = []
       result[n[0]] = tmp
@@ -177,8 +205,7 @@ class SetupParser:
 
   def parseStringArguments(self, args):
     result = []
-    p = re.compile('''(?:"([^"]+)"|'([^']+)'|([^,]+)),? ?''')
-    m = p.findall(args)
+    m = SetupParser.STRING_ARGUMENTS.findall(args)
     for n in m:
       if n[0] != '':
         result.append(n[0])
@@ -189,18 +216,20 @@ class SetupParser:
     return result
 
   def findHandler(self, line, handlers):
-    for handler in handlers:
-      p = re.compile('^' + handler + '$', re.DOTALL|re.IGNORECASE)
-      if p.match(line):
-        return handlers[handler]
-    return None
-
-  def findEntry(self, line, handlers):
-    for handler in handlers:
-      p = re.compile('^' + handler + '$', re.DOTALL|re.IGNORECASE)
-      m = p.match(line)
+    result = self.findEntry(line, SetupParser.GRAMMAR['sections'])
+    if result is None:
+      return None
+    return handlers[result[0]]
+
+  def findEntry(self, line, grammar):
+    """
+    Returns (value, groups) of the first entry in the compiled grammar
+    matching line, or None
+    """
+    for pattern, value in grammar:
+      m = pattern.match(line)
       if m:
-        return (handler, m.groups())
+        return (value, m.groups())
     return None
 
   def validateKeys(self, config, keys, optional = None , othersOk = False):
@@ -226,7 +255,7 @@ class SetupParser:
     if not valid: return err
 
     if 'ux-server' not in config['OPTIONS']: config['OPTIONS']['ux-server'] = ""
-    valid, err = self.validateKeys(config['OPTIONS'], ['pin-remote', 'ux-server'])
+    valid, err = self.validateKeys(config['OPTIONS'], ['pin-remote', 'ux-server'], ['ramp-rate', 'ramp-step'])
     if not valid: return 'Section "options", ' + err
 
     if len(config['DRIVER_TABLE']) == 0: return 'No devices defined'
@@ -331,18 +360,13 @@ class SetupParser:
 
     return {'warn' : warn, 'info' : info}
 
-  def instanciate(self, klass, arglist):
-    module = importlib.import_module('drivers.' + klass)
-    my_class = getattr(module, 'driver' + klass.capitalize())
-
-    args = ''
-    for a in arglist:
-      args += '"""%s""", ' % a
-    args = args[:-2]
+  def instanciate(self, device, klass, arglist):
+    return self.registry.create(device, klass, arglist)
 
-    return eval('my_class(%s)' % args)
-
-  def load(self, filename, config):
+  def parse(self, filename, config):
+    """
+    Parses filename into config without validating or loading anything
+    """
     handler = None
     temp = {}
     config['OPTIONS'] = {}
@@ -353,9 +377,9 @@ class SetupParser:
 
     tree = {
       'options' : self.handleOptions,
-      'device [a-zA-Z0-9]+' : self.handleDevice,
-      'scene [a-zA-Z0-9]+ ?: ?.+' : self.handleScene,
-      'zone [a-zA-Z0-9]+ ?: ?.+' : self.handleZone,
+      'device' : self.handleDevice,
+      'scene' : self.handleScene,
+      'zone' : self.handleZone,
     }
 
     with open(filename) as file:
@@ -377,19 +401,48 @@ class SetupParser:
           if not handler or handler(config, line, temp) == False:
             print(('ERROR: Unable to parse "%s" at line %d' % (line, l)))
             return False
+    return True
 
-    warn = []
-    info = []
-    err = self.findIssues(config)
-    if not isinstance(err, str):
+  def load(self, filename, config, cache=None):
+    """
+    Parses, validates and loads filename into config. If cache is given,
+    the validated configuration is compiled into it (see saveCache()) and
+    reused for as long as filename and the available drivers stay the same,
+    skipping parsing and validation.
+    """
+    self.compiled = None
+    compiled = None
+    if cache is not None:
+      key = self.cacheKey(filename)
+      compiled = self.readCache(cache, key)
+
+    if compiled is not None:
+      logging.info('Using compiled configuration from %s', cache)
+      config.update(compiled['config'])
+      config['ROUTES'] = {(z, sz, s): route for z, sz, s, route in compiled['routes']}
+      config['INCONCLUSIVE'] = compiled['inconclusive']
+      warn = compiled['warn']
+      info = compiled['info']
+    else:
+      if not self.parse(filename, config):
+        return False
+
+      err = self.findIssues(config)
+      if isinstance(err, str):
+        print("ERROR: Validation of configuration failed")
+        print(("       " + err))
+        return False
       warn = err['warn']
       info = err['info']
-      err = None
 
-    if err is not None:
-      print("ERROR: Validation of configuration failed")
-      print(("       " + err))
-      return False
+      if cache is not None:
+        self.compiled = {
+          'filename' : cache,
+          'key' : key,
+          'config' : copy.deepcopy(config),
+          'warn' : warn,
+          'info' : info,
+        }
 
     for w in warn:
       logging.warn(w)
@@ -404,10 +457,63 @@ class SetupParser:
 
         logging.debug("Loading " + driver)
         try:
-          config['DRIVER_TABLE'][item] = self.instanciate(driver, arguments)
+          config['DRIVER_TABLE'][item] = self.instanciate(item, driver, arguments)
         except:
           logging.exception(f'Unable to load driver {driver}')
-          config['DRIVER_TABLE'][item] = self.instanciate('base', []) # This should give us an empty shell
+          config['DRIVER_TABLE'][item] = self.instanciate(item, 'base', []) # This should give us an empty shell
         break
 
     return True
+
+  def cacheKey(self, filename):
+    """
+    Hash of what the compiled configuration depends on, which is the
+    configuration itself and the available drivers (names and source)
+    """
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'drivers')
+    key = hashlib.sha256()
+    key.update(str(SetupParser.CACHE_VERSION).encode())
+    with open(filename, 'rb') as file:
+      key.update(file.read())
+    for driver in sorted(f for f in os.listdir(folder) if f.endswith('.py')):
+      key.update(driver.encode())
+      with open(os.path.join(folder, driver), 'rb') as file:
+        key.update(file.read())
+    return key.hexdigest()
+
+  def readCache(self, filename, key):
+    """Returns the compiled configuration if it matches key, otherwise None"""
+    try:
+      with open(filename) as file:
+        compiled = json.load(file)
+    except FileNotFoundError:
+      return None
+    except:
+      logging.warning('Ignoring unreadable %s', filename)
+      return None
+    if not isinstance(compiled, dict) or compiled.get('key') != key:
+      logging.info('Configuration has changed since %s was written', filename)
+      return None
+    return compiled
+
+  def saveCache(self, routes, inconclusive):
+    """
+    Writes the configuration validated by load() along with the routes
+    Core compiled from it. Does nothing if it was loaded from the cache.
+    """
+    if self.compiled is None:
+      return
+    filename = self.compiled.pop('filename')
+    self.compiled['routes'] = [[z, sz, s, route] for (z, sz, s), route in routes.items()]
+    self.compiled['inconclusive'] = inconclusive
+    temp = filename + ".tmp"
+    try:
+      with open(temp, "w") as file:
+        file.write(json.dumps(self.compiled))
+        file.flush()
+        os.fsync(file.fileno())
+      os.replace(temp, filename)
+      logging.debug("Saved compiled configuration to %s", filename)
+    except:
+      logging.exception("Unable to save " + filename)
+    self.compiled = None
@@ -0,0 +1,175 @@
+# This file is part of multiRemote.
+#
+# multiRemote is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# multiRemote is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with multiRemote.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Press-and-hold volume control.
+
+Instead of a remote repeating volume up/down for as long as a button is
+held, it starts a ramp and stops it when the button is released. While
+the ramp runs, the volume of the zone is moved a step at a time by
+issuing an absolute volume set, at most once per tick and never while
+the previous one is still executing. The step is a percentage of the
+volume range of the driver (see driverBase.VOLUME_RANGE), ramps never go
+above the top of that range.
+
+Volume up/down commands issued to a zone with a running ramp are folded
+into the ramp instead of being queued on the driver.
+
+A ramp stops by itself after LIMIT seconds, in case the remote never
+sends stop.
+"""
+import threading
+import time
+import logging
+
+from .commandtype import CommandType
+
+class VolumeRamp(threading.Thread):
+  RATE = 10       # ticks per second
+  STEP = 2        # volume change per tick, in percent of the driver's range
+  LIMIT = 15      # seconds
+
+  def __init__(self, core, executor, rate=None, step=None):
+    threading.Thread.__init__(self)
+    self.CORE = core
+    self.EXECUTOR = executor
+    self.rate = rate or VolumeRamp.RATE
+    self.step = step or VolumeRamp.STEP
+    self.ramps = {}
+    self.absorbed = 0
+    self.issued = 0
+    self.lock = threading.Condition()
+
+    self.daemon = True
+    self.start()
+
+  def startRamp(self, zone, direction):
+    """
+    Starts (or reverses) a ramp in zone, direction is 1 or -1.
+    Returns an error message or None.
+    """
+    getter = self.CORE.getZoneCommandByType(zone, CommandType.VOLUME_GET)
+    setter = self.CORE.getZoneCommandByType(zone, CommandType.VOLUME_SET)
+    if getter is None or setter is None:
+      return "Zone %s cannot set volume" % zone
+
+    with self.lock:
+      if zone in self.ramps and self.ramps[zone]["setter"] == setter:
+        self.ramps[zone]["direction"] = direction
+        self.ramps[zone]["started"] = time.time()
+        return None
+      ramp = {
+        "direction" : direction,
+        "setter" : setter,
+        "level" : None,
+        "range" : setter[1].VOLUME_RANGE,
+        "nudge" : 0,
+        "busy" : True,
+        "started" : time.time(),
+      }
+      self.ramps[zone] = ramp
+
+    # Ramps are absolute, so we need to know where we start
+    (cmd, drv, drvzone) = getter
+    self.EXECUTOR.submit(drv, drv.handleCommand, drvzone, cmd, None).add_done_callback(lambda f: self.rampReady(zone, ramp, f))
+    return None
+
+  def rampReady(self, zone, ramp, future):
+    result = None if future.exception() else future.result()
+    with self.lock:
+      ramp["busy"] = False
+      if isinstance(result, dict) and "volume" in result:
+        ramp["level"] = int(result["volume"])
+        self.lock.notify()
+      else:
+        logging.warning('Unable to get volume of zone %s, ramp will not run', zone)
+        if self.ramps.get(zone) is ramp:
+          del self.ramps[zone]
+
+  def stopRamp(self, zone):
+    with self.lock:
+      self.ramps.pop(zone, None)
+
+  def isRamping(self, zone):
+    return zone in self.ramps
+
+  def absorb(self, zone, cmdtype):
+    """
+    Folds a volume up/down command into the ramp of the zone, returns
+    False if the zone has no ramp running.
+    """
+    with self.lock:
+      if zone not in self.ramps:
+        return False
+      if cmdtype == CommandType.VOLUME_UP:
+        self.ramps[zone]["nudge"] += 1
+      else:
+        self.ramps[zone]["nudge"] -= 1
+      self.absorbed += 1
+      return True
+
+  def tick(self):
+    """Called with lock held, issues the next volume set for each ramp"""
+    now = time.time()
+    for zone in list(self.ramps):
+      ramp = self.ramps[zone]
+      if now - ramp["started"] > VolumeRamp.LIMIT:
+        logging.warning('Ramp in zone %s was never stopped, stopping it', zone)
+        del self.ramps[zone]
+        continue
+      if ramp["busy"] or ramp["level"] is None:
+        continue
+      (low, high) = ramp["range"]
+      move = (ramp["direction"] + ramp["nudge"]) * self.step * (high - low) / 100.0
+      level = max(low, min(high, int(round(ramp["level"] + move))))
+      # Nudges (or starting outside the range) must never reverse the ramp
+      if ramp["direction"] > 0:
+        level = max(level, ramp["level"])
+      else:
+        level = min(level, ramp["level"])
+      ramp["nudge"] = 0
+      if level == ramp["level"]:
+        continue
+      ramp["level"] = level
+      ramp["busy"] = True
+      self.issued += 1
+      (cmd, drv, drvzone) = ramp["setter"]
+      self.EXECUTOR.submit(drv, drv.handleCommand, drvzone, cmd, level).add_done_callback(lambda f, ramp=ramp: self.setDone(ramp))
+
+  def setDone(self, ramp):
+    with self.lock:
+      ramp["busy"] = False
+
+  def run(self):
+    interval = 1.0 / self.rate
+    while True:
+      with self.lock:
+        while not self.ramps:
+          self.lock.wait()
+        self.tick()
+        self.lock.wait(interval)
+
+  def getStatus(self):
+    with self.lock:
+      ret = {
+        "rate" : self.rate,
+        "step" : self.step,
+        "issued" : self.issued,
+        "absorbed" : self.absorbed,
+        "active" : {},
+      }
+      for zone, ramp in self.ramps.items():
+        ret["active"][zone] = {"direction" : ramp["direction"], "level" : ramp["level"]}
+    return ret
@@ -0,0 +1,114 @@
+# This file is part of multiRemote.
+#
+# multiRemote is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# multiRemote is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with multiRemote.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Keeps track of the available drivers.
+
+A driver named "foo" lives in drivers/foo.py as the class driverFoo. Each
+driver module is only imported once, no matter how many devices use it.
+
+Drivers are initialized at the same time, each on its own lane. Startup
+waits up to INIT_TIMEOUT seconds (set per driver) for each of them, any
+driver still not done is reported as initializing and finishes in the
+background. Since it's running on its lane, commands for it are held
+until it's done. A driver which fails to initialize is replaced by an
+empty base driver, the same as when it cannot be created at all.
+
+The time each driver took to initialize is recorded, which is handy when
+figuring out why startup is slow.
+"""
+from concurrent.futures import wait
+import importlib
+import threading
+import logging
+import time
+
+class DriverRegistry:
+  def __init__(self):
+    self.classes = {}
+    self.timings = {}
+    self.lock = threading.Lock()
+
+  def getClass(self, driver):
+    """Returns the class implementing driver, importing it if needed"""
+    driver = driver.lower()
+    with self.lock:
+      if driver not in self.classes:
+        module = importlib.import_module('drivers.' + driver)
+        self.classes[driver] = getattr(module, 'driver' + driver.capitalize())
+      return self.classes[driver]
+
+  def create(self, device, driver, arguments):
+    """
+    Creates an instance of driver for device, arguments are passed on
+    as-is to the driver's init() once initialize() is called
+    """
+    instance = self.getClass(driver)(*arguments)
+    with self.lock:
+      self.timings[device] = {"driver" : driver, "status" : "pending"}
+    return instance
+
+  def initialize(self, executor, drivers, onReady=None):
+    """
+    Initializes all drivers (device -> instance) using their lanes and
+    waits until they're done or have run out of time. onReady(device)
+    is called whenever a driver is done, even if it failed (in which
+    case drivers holds its replacement by then).
+
+    Returns the list of devices still initializing.
+    """
+    start = time.time()
+    pending = []
+    for device, driver in drivers.items():
+      with self.lock:
+        self.timings[device]["status"] = "initializing"
+      future = executor.submit(driver, self.initDriver, executor, drivers, device, driver, onReady)
+      pending.append((start + driver.INIT_TIMEOUT, device, future))
+
+    slow = []
+    for deadline, device, future in sorted(pending, key=lambda p: p[0]):
+      done, _ = wait([future], max(0, deadline - time.time()))
+      if not done:
+        logging.warning('Device %s is still initializing, continuing without it', device)
+        slow.append(device)
+    logging.info('Drivers initialized in %dms', (time.time() - start) * 1000)
+    return slow
+
+  def initDriver(self, executor, drivers, device, driver, onReady):
+    start = time.time()
+    status = "ok"
+    try:
+      driver.initialize()
+    except:
+      logging.exception('Device %s failed to initialize', device)
+      status = "failed"
+    elapsed = (time.time() - start) * 1000
+    if status == "failed":
+      # A half initialized driver cannot be trusted, use an empty shell instead
+      shell = self.getClass('base')()
+      shell.setEventManager(driver.eventManager, driver.eventName)
+      shell.initialize()
+      executor.addDriver(device, shell)
+      drivers[device] = shell
+    logging.debug('Device %s took %dms to initialize', device, elapsed)
+    with self.lock:
+      self.timings[device]["status"] = status
+      self.timings[device]["init-ms"] = round(elapsed, 1)
+    if onReady is not None:
+      onReady(device)
+
+  def getStatus(self):
+    with self.lock:
+      return {device: dict(timing) for device, timing in self.timings.items()}
@@ -20,6 +20,9 @@ import json
 import base64
 import uuid
 import logging
+import threading
+import time
+import os
 
 """
 Remote registration and management is handled in this class.
@@ -31,9 +34,17 @@ native app or indeed another server.
 
 Each remote can have states associated with it, but these are not saved
 by the system. They are most definitely volatile :)
+
+Registrations are written in the background, shortly after the last
+change, so a burst of registrations only results in one write. The file
+is replaced atomically and the previous version is kept as a backup
+which is used if the file cannot be loaded.
 """
 class RemoteManager:
   FILENAME="remotes.json"
+  BACKUP="remotes.json.bak"
+  DELAY = 1       # seconds without changes before writing
+  MAX_DELAY = 5   # seconds, never hold changes longer than this
 
   def __init__(self):
     """
@@ -41,38 +52,100 @@ class RemoteManager:
     """
     self.REMOTES = self.load()
     self.STATE = {}
+    self.ZONES = {} # Reverse index of which remotes are attached to a zone
+
+    self.pending = None # Snapshot waiting to be written
+    self.firstChange = None
+    self.lastChange = None
+    self.lock = threading.Condition()
+    self.writeLock = threading.Lock()
+    self.writer = threading.Thread(target=self.writeBehind)
+    self.writer.daemon = True
+    self.writer.start()
 
   def load(self):
     """
-    Loads the remote object.
+    Loads the remote object, falling back to the backup if the file is
+    missing or damaged. A damaged file is never rotated into the backup,
+    see write().
     !DOES NOT VALIDATE THE DATA!
     """
-    data = {}
-    try:
-      jdata = open(self.FILENAME)
-      data = json.load(jdata)
-      jdata.close()
-    except:
-      logging.exception("Unable to load " + self.FILENAME)
-      return {}
-
-    return data;
+    self.rotate = True
+    for filename in [self.FILENAME, self.BACKUP]:
+      if not os.path.exists(filename):
+        continue
+      try:
+        with open(filename) as jdata:
+          return json.load(jdata)
+      except:
+        logging.exception("Unable to load " + filename)
+        if filename == self.FILENAME:
+          self.rotate = False
+    logging.error("No usable " + self.FILENAME + " found, starting without remotes")
+    return {}
 
   def save(self):
     """
-    Saves the remote object, unless it's empty
+    Queues the remote object for saving, unless it's empty
     """
     if len(self.REMOTES) == 0:
       logging.debug("No remotes in system, will not save")
       return
 
+    with self.lock:
+      # Entries are replaced, never modified, so a shallow copy is enough
+      self.pending = dict(self.REMOTES)
+      self.lastChange = time.time()
+      if self.firstChange is None:
+        self.firstChange = self.lastChange
+      self.lock.notify()
+
+  def writeBehind(self):
+    while True:
+      with self.lock:
+        while self.pending is None:
+          self.lock.wait()
+        now = time.time()
+        if now - self.lastChange < self.DELAY and now - self.firstChange < self.MAX_DELAY:
+          self.lock.wait(min(self.lastChange + self.DELAY, self.firstChange + self.MAX_DELAY) - now)
+          continue
+      self.flush()
+
+  def flush(self):
+    """
+    Writes any pending changes right away, used on shutdown
+    """
+    with self.writeLock:
+      with self.lock:
+        data = self.pending
+        self.pending = None
+        self.firstChange = None
+      if data is not None:
+        self.write(data)
+
+  def write(self, data):
+    """
+    Writes to a temporary file which then replaces the real one, so a
+    crash never leaves a partially written file behind.
+    """
+    temp = self.FILENAME + ".tmp"
     try:
-      jdata = open(self.FILENAME, "w")
-      jdata.write(json.dumps(self.REMOTES))
-      jdata.close()
+      with open(temp, "w") as jdata:
+        jdata.write(json.dumps(data))
+        jdata.flush()
+        os.fsync(jdata.fileno())
+      if self.rotate and os.path.exists(self.FILENAME):
+        os.replace(self.FILENAME, self.BACKUP)
+      os.replace(temp, self.FILENAME)
+      self.rotate = True
+      folder = os.open(os.path.dirname(os.path.abspath(self.FILENAME)), os.O_RDONLY)
+      try:
+        os.fsync(folder)
+      finally:
+        os.close(folder)
+      logging.debug("Saved %d remotes", len(data))
     except:
       logging.exception("Unable to save " + self.FILENAME)
-      return
 
   def register(self, name, desc, zone, existing=None):
     """
@@ -96,7 +169,9 @@ class RemoteManager:
     Removes a remote based on its UUID.
     """
     if uuid in self.REMOTES:
+      self.setZone(uuid, None)
       self.REMOTES.pop(uuid, None)
+      self.STATE.pop(uuid, None)
     else:
       logging.warning("Trying to remove " + uuid + " which does not exist")
     self.save()
@@ -138,4 +213,34 @@ class RemoteManager:
       return default
     if not key in self.STATE[uuid]:
       return default
-    return self.STATE[uuid][key]
\ No newline at end of file
+    return self.STATE[uuid][key]
+
+  def setZone(self, uuid, zone):
+    """
+    Attaches the remote to a zone (or detaches it if zone is None)
+    while keeping the zone index up to date.
+    """
+    if not uuid in self.REMOTES:
+      logging.warning("setZone() called on non-existant remote: " + uuid)
+      return
+    old = self.get(uuid, "active-zone")
+    if old in self.ZONES:
+      self.ZONES[old].pop(uuid, None)
+      if len(self.ZONES[old]) == 0:
+        del self.ZONES[old]
+    self.set(uuid, "active-zone", zone)
+    if zone is not None:
+      if zone not in self.ZONES:
+        self.ZONES[zone] = {}
+      self.ZONES[zone][uuid] = True
+
+  def getZone(self, uuid):
+    return self.get(uuid, "active-zone")
+
+  def getZoneRemotes(self, zone):
+    """
+    Returns an array of UUIDs attached to the zone
+    """
+    if zone not in self.ZONES:
+      return []
+    return list(self.ZONES[zone])
@@ -17,24 +17,36 @@
 Handles the actual control of the devices.
 
 It will process the routes in an atomical way to avoid an inconsistent state.
+
+Only the latest requested state matters, so if more changes are requested
+while the router is busy, only the newest is realized once it's done.
 """
+from concurrent.futures import Future
 import threading
-import queue
 import time
 import logging
 
 class Router (threading.Thread):
   DELAY = 30 # delay in seconds
-  workList = queue.Queue(10)
 
   prevState = {}
 
   CONFIG = None
 
-  def __init__(self, config):
+  def __init__(self, config, executor):
     threading.Thread.__init__(self)
 
     self.CONFIG = config
+    self.EXECUTOR = executor
+    self.lastSwitch = None
+    self.switches = 0
+    self.pending = None
+    self.skipped = 0
+    self.applied = {}
+    self.appliedExtras = {}
+    self.busy = False
+    self.waiting = []
+    self.lock = threading.Condition()
 
     self.daemon = True
     self.start()
@@ -46,21 +58,59 @@ class Router (threading.Thread):
     """
     state = self.CONFIG.getCurrentState()
     logging.debug("Queuing route change " + repr(state))
-    self.workList.put(state)
+    with self.lock:
+      if self.pending is not None:
+        logging.debug("Previously queued route change was superseded")
+        self.skipped += 1
+      self.pending = state
+      self.lock.notify()
+
+  def settled(self):
+    """
+    Returns a future which is done once all route changes queued so far
+    have been realized
+    """
+    future = Future()
+    with self.lock:
+      if self.pending is None and not self.busy:
+        future.set_result(None)
+      else:
+        self.waiting.append(future)
+    return future
 
   def run(self):
     """Takes care of incoming routing requests"""
     while True:
-      order = self.workList.get(True)
+      with self.lock:
+        while self.pending is None:
+          self.lock.wait()
+        order = self.pending
+        self.pending = None
+        self.busy = True
       self.processWorkOrder(order)
+      with self.lock:
+        self.busy = False
+        waiting = []
+        if self.pending is None:
+          waiting = self.waiting
+          self.waiting = []
+      for future in waiting:
+        future.set_result(None)
 
   def processWorkOrder(self, order):
-    """Figures out what parts that should be kept on, off or updated"""
+    """
+    Figures out what parts that should be kept on, off or updated.
+
+    All drivers are handled in parallel, the only ordering which is kept
+    is per driver (since each driver has its own lane), which means that
+    the initial commands and extras are sent once the driver has powered on.
+    """
     new_drivers = {}
     keep_drivers = {}
     inactive_drivers = []
 
     logging.debug("Processing route change " + repr(order))
+    measure = time.time()
 
     drivers = {}
     for z in order:
@@ -78,9 +128,10 @@ class Router (threading.Thread):
           inactive_drivers.append(d)
 
     """ Apply updates """
-    self.enableDrivers(new_drivers)
-    self.updateDrivers(keep_drivers)
-    self.disableDrivers(inactive_drivers)
+    pending = []
+    pending.extend(self.enableDrivers(new_drivers))
+    pending.extend(self.updateDrivers(keep_drivers))
+    pending.extend(self.disableDrivers(inactive_drivers))
 
     logging.debug("Router->On  = " + repr(new_drivers))
     logging.debug("Router->Upd = " + repr(keep_drivers))
@@ -90,73 +141,150 @@ class Router (threading.Thread):
     self.prevState = keep_drivers
     self.prevState.update(new_drivers)
 
-    """ Finally, execute any scene specific extras """
+    """ Finally, execute any scene specific extras, unless already applied """
+    for z in list(self.appliedExtras):
+      if z not in order:
+        self.appliedExtras.pop(z)
     for z in order:
       if "extras" in order[z]:
+        applied = (order[z].get("scene", None), order[z]["extras"])
+        if self.appliedExtras.get(z, None) == applied:
+          continue
         logging.debug(z + " has extras")
+        self.appliedExtras[z] = applied
         for e in order[z]["extras"]:
           logging.debug(e + " has params " + order[z]["extras"][e])
-          try:
-            self.CONFIG.getDriver(e).applyExtras(order[z]["extras"][e])
-          except:
-            logging.exception('Failed to applyExtras()')
+          driver = self.CONFIG.getDriver(e)
+          if driver is None:
+            continue
+          pending.append((self.EXECUTOR.submit(driver, driver.applyExtras, order[z]["extras"][e]), "Driver %s failed to applyExtras()" % driver, self.appliedExtras, z))
+
+    self.waitFor(pending)
+
+    measure = (time.time() - measure) * 1000
+    self.lastSwitch = int(measure)
+    self.switches += 1
+    logging.info("Route change took %dms", measure)
+
+  def waitFor(self, pending):
+    """
+    Waits for all (future, error message, state, driver or zone) to
+    complete, if a driver fails we no longer know its state so it's
+    removed from state (applied or appliedExtras) and the next update
+    sends everything.
+
+    Drivers fail by raising or returning False, None is success since
+    most commands don't return anything.
+    """
+    for future, error, state, key in pending:
+      try:
+        result = future.result()
+      except:
+        result = False
+      if result is False:
+        logging.error(error)
+        state.pop(key, None)
 
   def enableDrivers(self, drivers):
-    """Powers on drivers and sends list of inital commands"""
+    """Powers on drivers and queues list of inital commands"""
+    pending = []
     if drivers is None or len(drivers) == 0:
-      return
+      return pending
     for d in drivers:
       (name, zone) = self.splitDriverZone(d)
       driver = self.CONFIG.getDriver(name)
       if driver is None:
         continue
       logging.debug("Enabling %s" % driver)
-      try:
-        if zone is None:
-          driver.setPower(True)
-        else:
-          driver.setPower(zone, True)
-      except:
-        logging.exception("Driver %s failed to power on" % driver)
-      try:
-        for cmd in drivers[d]:
-          driver.handleCommand(zone, cmd, None)
-      except:
-        logging.exception("Driver %s failed during initial command setup" % driver)
+      if zone is None:
+        future = self.EXECUTOR.submit(driver, driver.setPower, True)
+      else:
+        future = self.EXECUTOR.submit(driver, driver.setPower, zone, True)
+      pending.append((future, "Driver %s failed to power on" % driver, self.applied, d))
+      for cmd in drivers[d]:
+        future = self.EXECUTOR.submit(driver, driver.handleCommand, zone, cmd, None)
+        pending.append((future, "Driver %s failed during initial command setup" % driver, self.applied, d))
+      self.applied[d] = drivers[d]
+    return pending
 
   def disableDrivers(self, drivers):
     """Powers off drivers"""
+    pending = []
     if drivers is None or len(drivers) == 0:
-      return
+      return pending
     for d in drivers:
       (name, zone) = self.splitDriverZone(d)
       driver = self.CONFIG.getDriver(name)
       if driver is None:
         continue
       logging.debug("Disabling %s" % driver)
-      try:
-        if zone is None:
-          driver.setPower(False)
-        else:
-          driver.setPower(zone, False)
-      except:
-        logging.error("Driver %s failed to power off" % driver)
+      if zone is None:
+        future = self.EXECUTOR.submit(driver, driver.setPower, False)
+      else:
+        future = self.EXECUTOR.submit(driver, driver.setPower, zone, False)
+      pending.append((future, "Driver %s failed to power off" % driver, self.applied, d))
+      self.applied.pop(d, None)
+    return pending
 
   def updateDrivers(self, drivers):
-    """Sends new list of commands to drivers"""
+    """Queues the commands which changed since last time to drivers"""
+    pending = []
     if drivers is None or len(drivers) == 0:
-      return
+      return pending
     for d in drivers:
       (name, zone) = self.splitDriverZone(d)
       driver = self.CONFIG.getDriver(name)
       if driver is None:
         continue
-      logging.debug("Updating %s" % driver)
-      try:
-        for cmd in drivers[d]:
-          driver.handleCommand(zone, cmd, None)
-      except:
-        logging.error("Driver %s failed to update state" % driver)
+      cmds = self.filterCommands(d, driver, drivers[d])
+      if len(cmds) == 0:
+        continue
+      logging.debug("Updating %s with %s" % (driver, repr(cmds)))
+      for cmd in cmds:
+        future = self.EXECUTOR.submit(driver, driver.handleCommand, zone, cmd, None)
+        pending.append((future, "Driver %s failed to update state" % driver, self.applied, d))
+      self.applied[d] = drivers[d]
+    return pending
+
+  def filterCommands(self, d, driver, commands):
+    """
+    Removes commands which already are in effect for the driver (and zone).
+    If the list of commands is the same as last time, nothing is sent,
+    otherwise commands flagged with FLAG_KEEP_STATE are only sent if
+    they differ from the last command sent in the same group.
+    """
+    if d not in self.applied:
+      return commands
+    if self.applied[d] == commands:
+      return []
+
+    state = {}
+    for cmd in self.applied[d]:
+      group = driver.getCommandGroup(cmd)
+      if group is not None:
+        state[group] = cmd
+
+    result = []
+    for cmd in commands:
+      group = driver.getCommandGroup(cmd)
+      if group is None or state.get(group, None) != cmd:
+        result.append(cmd)
+    return result
+
+  def forgetState(self, driver):
+    """
+    Forgets the commands applied to driver (and zone), used when something
+    else changes its state so the next update sends everything again.
+    """
+    self.applied.pop(driver, None)
+
+  def getStatus(self):
+    """Details about the router, used for debugging"""
+    return {
+      "route-changes" : self.switches,
+      "last-route-change-ms" : self.lastSwitch,
+      "skipped-route-changes" : self.skipped,
+    }
 
   def splitDriverZone(self, driver):
     """Splits drivers with zoning support into two parts"""
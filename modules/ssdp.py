@@ -22,10 +22,15 @@ Creates a simple UDP server which listens for the following services:
 
 If it sees any M-SEARCH for them, it responds in kind.
 
+It runs on the IOLoop as a datagram protocol, NOTIFY messages are sent
+using a timer.
+
+Responses only differ in which address they point to, so they're built
+once per interface and refreshed every REFRESH seconds, as is the table
+used to figure out which interface a search came from.
 """
 import socket
-import threading
-import time
+import asyncio
 import struct
 import ipaddress
 import netifaces
@@ -35,8 +40,13 @@ import json
 import os.path
 import sys
 
-class SSDPHandler (threading.Thread):
+from tornado.ioloop import IOLoop
+
+class SSDPHandler:
   CONFIGFILE = "ssdp-info.json"
+  REFRESH = 60          # seconds between rescans of interfaces
+  SENDER_CACHE = 1024   # max number of senders to remember
+  REOPEN = 5            # seconds to wait before recreating lost sockets
 
   """
   location should be an URL where the web interface is hosted.
@@ -48,8 +58,6 @@ class SSDPHandler (threading.Thread):
 
   """
   def __init__(self, location, port, notifyInterval=15, listen=''):
-    threading.Thread.__init__(self)
-    self.daemon = True
     self.listen = listen
     self.location = location
     self.port = port
@@ -59,13 +67,21 @@ class SSDPHandler (threading.Thread):
 
     self.sender = None
     self.listener = None
-    self.lastinit = 0
+    self.notifyTimer = None
+    self.refreshTimer = None
+    self.reopening = False
+
+    self.interfaces = [] # (network, response)
+    self.senders = {}    # sender address -> response
 
     self.load()
     if self.usn is None:
       self.usn = 'uuid:%s' % uuid.uuid4()
       self.save()
 
+    self.notification = self.buildMessage('NOTIFY * HTTP/1.1', '*')
+    self.xml = self.buildXML()
+
   def load(self):
     if not os.path.isfile(self.CONFIGFILE):
       return
@@ -98,74 +114,130 @@ class SSDPHandler (threading.Thread):
   def getURN(self):
     return self.urn
 
-  def _initSSDP(self):
+  class Protocol(asyncio.DatagramProtocol):
+    def __init__(self, handler, name):
+      self.handler = handler
+      self.name = name
+
+    def datagram_received(self, data, sender):
+      self.handler.handleDatagram(data, sender)
+
+    def error_received(self, exc):
+      # Errors on UDP sockets are reported per datagram, socket is still fine
+      logging.warning('SSDP %s socket reported: %s', self.name, str(exc))
+
+    def connection_lost(self, exc):
+      if exc is not None:
+        logging.error('SSDP %s socket was lost: %s', self.name, str(exc))
+        self.handler.reopen()
+
+  def start(self):
+    """
+    Starts SSDP on the IOLoop, must be called from the thread running it
+    """
+    IOLoop.current().add_callback(self.open)
+
+  async def open(self):
     logging.info('Init SSDP')
-    if (time.time() - self.lastinit) < 1:
-      logging.error('We have been reiniting the SSDP service too often, abort!')
-      raise Exception('SSDP reinit failure')
-
-    self.lastinit = time.time()
-    if self.sender is not None:
-      try:
-        self.sender.close()
-      except:
-        logging.exception('Unable to close sender socket')
-      finally:
-        self.sender = None
-    if self.listener is not None:
-      try:
-        self.listener.close()
-      except:
-        logging.exception('Unable to close listener socket')
-      finally:
-        self.listener = None
-
-    self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    self.sender.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    self.sender.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    self.sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 4)
-
-    self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    self.listener.bind((self.listen, 1900))
-
-    request = struct.pack('4sL', socket.inet_aton('239.255.255.250'), socket.INADDR_ANY)
-    self.listener.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, request)
-    self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8192*2)
-    # Make sure we don't get stuck longer than 1s so we also can notify
-    self.listener.settimeout(1)
-
-  def run(self):
-    self._initSSDP()
-
-    nextNotify = 0
-    while True:
-      try:
-        if nextNotify < time.time():
-          if not self.sendNotify():
-            raise Exception('Send failed, ugly way to trigger re-init')
-          nextNotify = time.time() + self.notifyInterval
-        data, sender = self.listener.recvfrom(1400)
-        data = data.decode('utf-8')
-        data = data.split('\r\n')
-        if data[0] == 'M-SEARCH * HTTP/1.1':
-          #logging.debug('Search request from: ' + repr(sender))
-          self.handleSearch(sender, data)
-      except socket.timeout:
-        pass # Ignore, it's by design
-      except:
-        logging.exception('Got an exception in main read loop, try re-init')
-        # Reinit SSDP just-in-case
-        nextNotify = 0
-        self._initSSDP()
-
-  def resolveHost(self, sender):
+    self.close()
+    loop = asyncio.get_running_loop()
+    sender = None
+    listener = None
+    try:
+      sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      sender.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      sender.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+      sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 4)
+      self.sender, _ = await loop.create_datagram_endpoint(lambda: SSDPHandler.Protocol(self, 'sender'), sock=sender)
+      sender = None # Owned by the transport now
+
+      listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+      listener.bind((self.listen, 1900))
+      request = struct.pack('4sL', socket.inet_aton('239.255.255.250'), socket.INADDR_ANY)
+      listener.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, request)
+      listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8192*2)
+      self.listener, _ = await loop.create_datagram_endpoint(lambda: SSDPHandler.Protocol(self, 'listener'), sock=listener)
+    except:
+      logging.exception('Unable to setup SSDP')
+      for sock in [sender, listener]:
+        if sock is not None:
+          sock.close()
+      self.reopen()
+      return
+
+    self.refreshInterfaces()
+    self.sendNotify()
+
+  def close(self):
+    for transport in [self.sender, self.listener]:
+      if transport is not None:
+        transport.close()
+    self.sender = None
+    self.listener = None
+    for timer in [self.notifyTimer, self.refreshTimer]:
+      if timer is not None:
+        timer.cancel()
+    self.notifyTimer = None
+    self.refreshTimer = None
+
+  def reopen(self):
+    """
+    Sockets are only recreated if they're lost, and not more often than
+    every REOPEN seconds
+    """
+    if self.reopening:
+      return
+    self.reopening = True
+    self.close()
+    asyncio.get_running_loop().call_later(self.REOPEN, self.reopened)
+
+  def reopened(self):
+    self.reopening = False
+    IOLoop.current().add_callback(self.open)
+
+  def handleDatagram(self, data, sender):
+    try:
+      data = data.decode('utf-8').split('\r\n')
+    except UnicodeDecodeError:
+      return
+    if data[0] == 'M-SEARCH * HTTP/1.1':
+      self.handleSearch(sender, data)
+
+  def refreshInterfaces(self):
+    """
+    Rebuilds the table of interfaces along with the response to send
+    to searches coming from each of them
+    """
+    interfaces = []
     for i in netifaces.interfaces():
-      if netifaces.AF_INET not in netifaces.ifaddresses(i):
+      addresses = netifaces.ifaddresses(i)
+      if netifaces.AF_INET not in addresses:
         continue
-      ii = netifaces.ifaddresses(i)[netifaces.AF_INET][0]
-      if ipaddress.ip_address(str(sender)) in ipaddress.ip_network(str(ii['addr'] + '/' + ii['netmask']), strict=False):
-        return ii['addr']
-    return None
+      ii = addresses[netifaces.AF_INET][0]
+      network = ipaddress.ip_network(str(ii['addr'] + '/' + ii['netmask']), strict=False)
+      location = 'http://%s:%d/description.xml' % (ii['addr'], self.port)
+      interfaces.append((network, self.buildMessage('HTTP/1.1 200 OK', location)))
+    self.interfaces = interfaces
+    self.senders = {}
+    self.refreshTimer = asyncio.get_running_loop().call_later(self.REFRESH, self.refreshInterfaces)
+
+  def resolveResponse(self, sender):
+    """
+    Returns the response for a search from sender, or None if sender
+    isn't on any of our networks
+    """
+    if sender in self.senders:
+      return self.senders[sender]
+    address = ipaddress.ip_address(str(sender))
+    response = None
+    for network, msg in self.interfaces:
+      if address in network:
+        response = msg
+        break
+    if len(self.senders) >= self.SENDER_CACHE:
+      self.senders = {}
+    self.senders[sender] = response
+    return response
 
   def handleSearch(self, sender, content):
     for line in content:
@@ -173,41 +245,34 @@ class SSDPHandler (threading.Thread):
         self.sendResponse(sender)
         break
 
-  def sendNotify(self):
-    msg  = 'NOTIFY * HTTP/1.1\r\n'
+  def buildMessage(self, status, location):
+    msg  = '%s\r\n' % status
     msg += 'Host: 239.255.255.250:1900\r\n'
-    msg += 'Location: *\r\n'
+    msg += 'Location: %s\r\n' % location
     msg += 'Server: multiRemote/1.0\r\n'
     msg += 'NT: %s\r\n' % self.urn
     msg += 'NTS: ssdp:alive\r\n'
     msg += 'USN: %s\r\n' % self.usn
     msg += 'Cache-Control: max-age=120\r\n'
     msg += '\r\n'
+    return msg.encode('utf-8')
 
-    if self.sender.sendto(bytes(msg, encoding='utf-8'), ('239.255.255.250', 1900)) < len(msg):
-      logging.error('Sending notification failed')
-      return False
-    return True
+  def sendNotify(self):
+    self.sender.sendto(self.notification, ('239.255.255.250', 1900))
+    self.notifyTimer = asyncio.get_running_loop().call_later(self.notifyInterval, self.sendNotify)
 
   def sendResponse(self, sender):
-    host = self.resolveHost(sender[0])
-    if host is None:
-      print("ERROR: SSDP source could not be resolved to interface")
+    msg = self.resolveResponse(sender[0])
+    if msg is None:
+      logging.debug("SSDP source %s could not be resolved to interface", sender[0])
       return
 
-    msg  = 'HTTP/1.1 200 OK\r\n'
-    msg += 'Host: 239.255.255.250:1900\r\n'
-    msg += 'Location: http://%s:%d/description.xml\r\n' % (host, self.port)
-    msg += 'Server: multiRemote/1.0\r\n'
-    msg += 'NT: %s\r\n' % self.urn
-    msg += 'NTS: ssdp:alive\r\n'
-    msg += 'USN: %s\r\n' % self.usn
-    msg += 'Cache-Control: max-age=120\r\n'
-    msg += '\r\n'
-
-    self.sender.sendto(msg.encode(), sender)
+    self.sender.sendto(msg, sender)
 
   def generateXML(self):
+    return self.xml
+
+  def buildXML(self):
     result = """<?xml version="1.0" encoding="UTF-8"?>
 <root xmlns="urn:schemas-upnp-org:device-1-0">
    <specVersion>
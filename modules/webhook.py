@@ -21,7 +21,12 @@ import base64
 import uuid
 import logging
 import os
+import time
+import threading
 import requests
+from urllib.parse import urlparse
+
+from modules.executor import Worker, gather
 
 """
 Webhook Manager allows for registration of outgoing webhooks.
@@ -33,7 +38,116 @@ The manager will read a configuration file where the user
 can define endpoints to call based on certain events.
 
 For now, only query parameters and JSON payloads are supported.
+
+Calls are made by WebhookDispatcher in the background so a slow
+endpoint never holds up the caller.
 """
+class WebhookDispatcher:
+  """
+  Calls endpoints in the background. Each host gets a worker of its own,
+  so calls to the same host are done in order, while separate hosts
+  don't wait on each other. Connections are kept alive using a session
+  per host.
+
+  Failed calls (connection errors, timeouts and 5xx responses) are
+  retried RETRIES times, waiting BACKOFF seconds before the first retry
+  and doubling it for each one after.
+  """
+  TIMEOUT = 5     # seconds
+  RETRIES = 3
+  BACKOFF = 0.5   # seconds
+  BUCKETS = [50, 100, 250, 500, 1000, 2500, 5000] # latency histogram, in ms
+
+  def __init__(self):
+    self.workers = {}
+    self.sessions = {}
+    self.stats = {}
+    self.lock = threading.Lock()
+
+  def dispatch(self, endpoints):
+    """
+    Queues the endpoints for calling on the worker of their host, returns
+    a future which is done once all of them are
+    """
+    futures = []
+    for endpoint in endpoints:
+      host = urlparse(endpoint['url']).netloc
+      with self.lock:
+        if host not in self.workers:
+          self.workers[host] = Worker('webhook-%s' % host)
+        worker = self.workers[host]
+      futures.append(worker.submit(self.callEndpoint, endpoint))
+    return gather(futures)
+
+  def getSession(self, host):
+    # Sessions are shared between lanes, requests keeps a connection
+    # pool per session which is safe to use from multiple threads
+    with self.lock:
+      if host not in self.sessions:
+        self.sessions[host] = requests.Session()
+        self.stats[host] = {
+          'success' : 0,
+          'failure' : 0,
+          'retries' : 0,
+          'latency' : [0] * (len(WebhookDispatcher.BUCKETS) + 1),
+        }
+      return self.sessions[host]
+
+  def record(self, host, key, elapsed=None):
+    with self.lock:
+      stats = self.stats[host]
+      stats[key] += 1
+      if elapsed is None:
+        return
+      bucket = 0
+      while bucket < len(WebhookDispatcher.BUCKETS) and elapsed > WebhookDispatcher.BUCKETS[bucket]:
+        bucket += 1
+      stats['latency'][bucket] += 1
+
+  def callEndpoint(self, endpoint):
+    host = urlparse(endpoint['url']).netloc
+    session = self.getSession(host)
+    delay = WebhookDispatcher.BACKOFF
+    for attempt in range(WebhookDispatcher.RETRIES + 1):
+      if attempt > 0:
+        self.record(host, 'retries')
+        time.sleep(delay)
+        delay *= 2
+      start = time.time()
+      try:
+        logging.debug('Calling "%s"', endpoint['url'])
+        if endpoint['data'] != None:
+          result = session.post(endpoint['url'], data=endpoint['data'], timeout=WebhookDispatcher.TIMEOUT)
+        else:
+          result = session.get(endpoint['url'], timeout=WebhookDispatcher.TIMEOUT)
+      except requests.exceptions.RequestException as e:
+        logging.warning('Calling %s failed (attempt %d): %s', endpoint['url'], attempt + 1, str(e))
+        continue
+      elapsed = (time.time() - start) * 1000
+      logging.info('Result: %d %s (%dms)', result.status_code, result.reason, elapsed)
+      if result.status_code >= 500:
+        continue
+      self.record(host, 'success' if result.status_code < 400 else 'failure', elapsed)
+      return result.status_code < 400
+    logging.error('Giving up on %s after %d attempts', endpoint['url'], WebhookDispatcher.RETRIES + 1)
+    self.record(host, 'failure')
+    return False
+
+  def getStatus(self):
+    labels = ['<=%dms' % b for b in WebhookDispatcher.BUCKETS] + ['>%dms' % WebhookDispatcher.BUCKETS[-1]]
+    ret = {"hosts" : {}, "queued" : 0}
+    with self.lock:
+      for host, stats in self.stats.items():
+        ret["hosts"][host] = {
+          'success' : stats['success'],
+          'failure' : stats['failure'],
+          'retries' : stats['retries'],
+          'latency' : dict(zip(labels, stats['latency'])),
+        }
+      for worker in self.workers.values():
+        ret["queued"] += worker.depth()
+    return ret
+
 class WebhookManager:
   ACTIVE = 'active'
   INACTIVE = 'inactive'
@@ -42,6 +156,9 @@ class WebhookManager:
   def __init__(self):
     self.attributes = {}
     self.hooks = []
+    self.index = {} # attribute -> hooks checking it
+    self.evaluated = False
+    self.dispatcher = WebhookDispatcher()
 
   def load(self, filename):
     if not os.path.exists(filename):
@@ -63,6 +180,7 @@ class WebhookManager:
           cmd = parts[0].lower()
           if cmd == 'when':
             hook = {
+              'index':len(self.hooks),
               'checks':[],
               'start':[],
               'end':[],
@@ -101,8 +219,19 @@ class WebhookManager:
           return False
     logging.debug('Webhooks loaded')
     logging.debug(repr(self.hooks))
+    self.build_index()
     return True
 
+  def build_index(self):
+    # Maps attributes to the hooks checking them, so an update only
+    # needs to evaluate the affected hooks
+    self.index = {}
+    for hook in self.hooks:
+      for check in hook['checks']:
+        hooks = self.index.setdefault(check['attribute'], [])
+        if hook['index'] not in [h['index'] for h in hooks]:
+          hooks.append(hook)
+
   def register_attribute(self, name):
     # Registers an attribute, otherwise it cannot be set
     if name in self.attributes:
@@ -111,16 +240,37 @@ class WebhookManager:
       self.attributes[name] = None
 
   def update_attribute(self, name, value):
-    if name not in self.attributes:
-      logging.error('Attribute "%s" is not registered, cannot update', name)
-      return False
-    self.attributes[name] = value
-    self.evaluate_hooks()
+    return self.update_attributes({name: value})
+
+  def update_attributes(self, values):
+    """
+    Updates several attributes at once and evaluates the affected hooks
+    once, so intermediate states never trigger any hooks. Nothing is
+    updated if any of the attributes isn't registered.
+    """
+    for name in values:
+      if name not in self.attributes:
+        logging.error('Attribute "%s" is not registered, cannot update', name)
+        return False
+
+    # The first update evaluates everything, since hooks may be true
+    # before any of their attributes have changed (ie, neq)
+    affected = {} if self.evaluated else {hook['index']: hook for hook in self.hooks}
+    self.evaluated = True
+    for name, value in values.items():
+      if self.attributes[name] == value:
+        continue
+      self.attributes[name] = value
+      for hook in self.index.get(name.lower(), []):
+        affected[hook['index']] = hook
+
+    if affected:
+      logging.debug('Attributes are: %s', repr(self.attributes))
+      self.evaluate_hooks([affected[i] for i in sorted(affected)])
     return True
 
   def is_when(self, hook):
     final = None
-    logging.debug('Attributes are: %s', repr(self.attributes))
     for check in hook['checks']:
       state = self.attributes[check['attribute']]
       result = None
@@ -141,23 +291,21 @@ class WebhookManager:
         break
     return final
 
-  def evaluate_hooks(self):
-    for hook in self.hooks:
-      if self.is_when(hook) and not hook['active']:
+  def evaluate_hooks(self, hooks=None):
+    if hooks is None:
+      hooks = self.hooks
+    for hook in hooks:
+      when = self.is_when(hook)
+      if when and not hook['active']:
         hook['active'] = True
         self.call_hooks(hook['start'])
-      elif not self.is_when(hook) and hook['active']:
+      elif not when and hook['active']:
         hook['active'] = False
         self.call_hooks(hook['end'])
 
   def call_hooks(self, endpoints):
-    for endpoint in endpoints:
-      try:
-        logging.debug('Calling "%s"', endpoint['url'])
-        if endpoint['data'] != None:
-          result = requests.post(endpoint['url'], data=endpoint['data'])
-        else:
-          result = requests.get(endpoint['url'])
-        logging.info('Result: %d %s', result.status_code, result.reason)
-      except:
-        logging.exception('GET %s failed', endpoint['url'])
+    if endpoints:
+      self.dispatcher.dispatch(endpoints)
+
+  def get_status(self):
+    return self.dispatcher.getStatus()
@@ -31,6 +31,7 @@ import logging
 import argparse
 import sys
 import os
+import signal
 
 """ Parse command line """
 parser = argparse.ArgumentParser(description="multiRemote - The future of IoT based remote control for your home", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -51,12 +52,12 @@ else:
 
 """ Continue with the rest """
 
-from tornado.wsgi import WSGIContainer
 from tornado.ioloop import IOLoop
-from tornado.web import Application, FallbackHandler
+from tornado.web import Application, RequestHandler, StaticFileHandler, RedirectHandler, HTTPError
 from tornado.websocket import WebSocketHandler
 
-from flask import Flask, jsonify, Response, abort, send_from_directory
+from concurrent.futures import Future
+import asyncio
 import threading
 import queue
 import time
@@ -69,23 +70,6 @@ from modules.parser import SetupParser
 from modules.api import multiremoteAPI
 from modules.eventmgr import EventHandler
 
-try:
-  from flask_cors import CORS # The typical way to import flask-cors
-except ImportError:
-  # Path hack allows examples to be run without installation.
-  import os
-  parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-  os.sys.path.insert(0, parentdir)
-  from flask_cors import CORS
-
-""" Disable some logging by-default """
-logging.getLogger("Flask-Cors").setLevel(logging.ERROR)
-logging.getLogger("werkzeug").setLevel(logging.ERROR)
-
-""" Initialize the REST server """
-app = Flask(__name__, static_url_path='')
-cors = CORS(app) # Needed to make us CORS compatible
-
 """ Create the various cogs of the machinery """
 
 class WorkRunner(threading.Thread):
@@ -93,18 +77,23 @@ class WorkRunner(threading.Thread):
     def __init__(self, task, *args):
       self.task = task
       self.args = args
-      self.event = threading.Event()
-      self.result = None
+      self.future = Future()
 
     def wait(self):
-      self.event.wait()
+      return self.future.result()
 
     def execute(self):
-      self.result = self.task(*self.args)
-      self.event.set()
+      if not self.future.set_running_or_notify_cancel():
+        return
+      try:
+        self.future.set_result(self.task(*self.args))
+      except Exception as e:
+        logging.exception('Work failed')
+        self.future.set_exception(e)
 
   def __init__(self):
     threading.Thread.__init__(self)
+    self.daemon = True
     self.queue = queue.Queue()
     self.start()
 
@@ -116,9 +105,18 @@ class WorkRunner(threading.Thread):
 
   def synctask(self, task, *args):
     #logging.debug('synctask called')
-    w = self.asynctask(task, *args)
-    w.wait()
-    return w.result
+    return self.asynctask(task, *args).wait()
+
+  async def awaitable(self, task, *args):
+    """
+    Same as asynctask() but can be awaited from the IOLoop without
+    blocking it. If the task handed the work over to a driver lane,
+    the result of the lane is awaited as well.
+    """
+    result = await asyncio.wrap_future(self.asynctask(task, *args).future)
+    if isinstance(result, Future):
+      result = await asyncio.wrap_future(result)
+    return result
 
   def run(self):
     while True:
@@ -129,143 +127,67 @@ class WorkRunner(threading.Thread):
 workRunner = WorkRunner()
 
 api = multiremoteAPI()
-api.init(cmdline)
+api.init(cmdline, workRunner.asynctask)
 
 """ Start defining REST end-points """
-@app.route("/")
-def api_root():
-  data = workRunner.synctask(api.getStatus)
-  result = jsonify(data)
-  result.status_code = 200
-  return result
-
-@app.route("/scene", defaults={"scene" : None})
-@app.route("/scene/<scene>")
-def api_scene(scene):
-  """
-  Allows probing of the various scenes provided by multiREMOTE
-  """
-  data = workRunner.synctask(api.getScene, scene)
-  ret = jsonify(data)
-  ret.status_code = 200
-  return ret
-
-@app.route("/zone", defaults={"zone" : None})
-@app.route("/zone/<zone>")
-def api_zone(zone):
-  """
-  Allows probing of the various zones provided by multiREMOTE
-  """
-  data = workRunner.synctask(api.getZone, zone)
-  ret = jsonify(data)
-  ret.status_code = 200
-  return ret
-
-@app.route("/subzone/<zone>", defaults={"subzone" : None})
-@app.route("/subzone/<zone>/<subzone>")
-def api_subzone(zone, subzone):
+class APIHandler(RequestHandler):
   """
-  Changes the subzone for a specific zone
+  Runs the provided API function on the WorkRunner and replies with
+  the result as JSON. All regex groups of the route are passed as
+  arguments, unmatched optional groups are passed as None.
   """
-  data = workRunner.synctask(api.getSubZone, zone, subzone)
-  ret = jsonify(data)
-  ret.status_code = 200
-  return ret
-
-@app.route("/assign", defaults={"zone" : None, "scene" : None, "options" : None})
-@app.route("/assign/<zone>", defaults={"scene" : None, "options" : None, "remote" : None})
-@app.route("/assign/<zone>/<remote>/<scene>", defaults={"options" : None})
-@app.route("/assign/<zone>/<remote>/<scene>/<options>")
-def api_assign(zone, remote, scene, options):
-  data = workRunner.synctask(api.assignZone, zone, remote, scene, options)
-  ret = jsonify(data)
-  ret.status_code = 200
-  return ret
-
-@app.route("/unassign", defaults={"zone" : None, "remote" : None})
-@app.route("/unassign/<zone>/<remote>")
-def api_unassign(zone, remote):
-  data = workRunner.synctask(api.unassignZone, zone, remote)
-  ret = jsonify(data)
-  ret.status_code = 200
-  return ret
-
-@app.route("/attach", defaults={"remote" : None, "zone" : None, "options" : None})
-@app.route("/attach/<remote>", defaults={"zone" : None, "options" : None})
-@app.route("/attach/<remote>/<zone>", defaults={"options" : None})
-@app.route("/attach/<remote>/<zone>/<options>")
-def api_attach(remote, zone, options):
-  data = workRunner.synctask(api.attachRemote, remote, zone, options)
-  ret = jsonify(data)
-  ret.status_code = 200
-  return ret
-
-@app.route("/detach/<remote>")
-def api_detach(remote):
-  data = workRunner.synctask(api.detachRemote, remote)
-  ret = jsonify(data)
-  ret.status_code = 200
-  return ret
-
-@app.route("/command/<remote>", defaults={"command" : None, "arguments" : None, "category" : None})
-@app.route("/command/<remote>/<category>/<command>", defaults={"arguments" : None})
-@app.route("/command/<remote>/<category>/<command>/<arguments>")
-def api_command(remote, category, command, arguments):
-  data = workRunner.synctask(api.executeCommand, remote, category, command, arguments)
-  ret = jsonify(data)
-  ret.status_code = 200
-  return ret
-
-@app.route("/debug")
-def api_debug():
-  data = workRunner.synctask(api.getDebugInformation)
-  ret = jsonify(data)
-  ret.status_code = 200
-  return ret
-
-@app.route("/register/<pin>/<name>/<desc>/<zone>")
-def api_register(pin, name, desc, zone):
-  data = workRunner.synctask(api.registerRemote, pin, name, desc, zone)
-  ret = jsonify(data)
-  ret.status_code = 200
-  return ret
-
-@app.route("/unregister/<pin>/<uuid>")
-def api_unregister(pin, uuid):
-  data = workRunner.synctask(api.unregisterRemote, pin, uuid)
-  ret = jsonify(data)
-  ret.status_code = 200
-  return ret
-
-@app.route("/remotes", defaults={"uuid": None})
-@app.route("/remotes/<uuid>")
-def api_remotes(uuid):
-  data = workRunner.synctask(api.getRemotes, uuid)
-  ret = jsonify(data)
-  ret.status_code = 200
-  return ret
-
-@app.route("/description.xml")
-def api_ssdp():
-  data = workRunner.synctask(api.getSSDPDescriptor)
-  return Response(data, mimetype='text/xml')
-
-@app.route('/ux', defaults={'path' : None})
-@app.route('/ux/', defaults={'path' : None})
-@app.route("/ux/<path:path>")
-def serve_html(path):
-  print((repr(path)))
-  if cmdline.host is None:
+  def initialize(self, task):
+    self.task = task
+
+  def set_default_headers(self):
+    # Needed to make us CORS compatible
+    self.set_header('Access-Control-Allow-Origin', '*')
+
+  def options(self, *args):
+    self.set_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
+    self.set_status(204)
+
+  async def get(self, *args):
+    data = await workRunner.awaitable(self.task, *args)
+    self.write(data)
+
+class SSDPDescriptorHandler(APIHandler):
+  async def get(self):
+    data = await workRunner.awaitable(self.task)
+    self.set_header('Content-Type', 'text/xml')
+    self.write(data)
+
+class NoUXHandler(RequestHandler):
+  def get(self, path):
     logging.warning('Client tried to access UX hosting when not enabled')
-    abort(404)
-  else:
-    if path is None:
-      path = 'index.html'
-    actual = os.path.abspath(os.path.join(cmdline.host, path))
-    if not os.path.exists(actual):
-      logging.error('Unable to server %s, does not exist', actual)
-    #logging.debug('Sending file %s from %s', path, os.path.abspath(cmdline.host))
-    return send_from_directory(os.path.abspath(cmdline.host), path)
+    raise HTTPError(404)
+
+ARG = '/([^/]+)'
+
+routes = [
+  (r'/', APIHandler, dict(task=api.getStatus)),
+  (r'/scene(?:%s)?' % ARG, APIHandler, dict(task=api.getScene)),
+  (r'/zone(?:%s)?' % ARG, APIHandler, dict(task=api.getZone)),
+  (r'/subzone%s(?:%s)?' % (ARG, ARG), APIHandler, dict(task=api.getSubZone)),
+  (r'/assign(?:%s(?:%s%s(?:%s)?)?)?' % (ARG, ARG, ARG, ARG), APIHandler, dict(task=api.assignZone)),
+  (r'/unassign(?:%s%s)?' % (ARG, ARG), APIHandler, dict(task=api.unassignZone)),
+  (r'/attach(?:%s(?:%s(?:%s)?)?)?' % (ARG, ARG, ARG), APIHandler, dict(task=api.attachRemote)),
+  (r'/detach%s' % ARG, APIHandler, dict(task=api.detachRemote)),
+  (r'/command%s(?:%s%s(?:%s)?)?' % (ARG, ARG, ARG, ARG), APIHandler, dict(task=api.executeCommand)),
+  (r'/ramp%s(?:%s)?' % (ARG, ARG), APIHandler, dict(task=api.rampVolume)),
+  (r'/debug', APIHandler, dict(task=api.getDebugInformation)),
+  (r'/register%s%s%s%s' % (ARG, ARG, ARG, ARG), APIHandler, dict(task=api.registerRemote)),
+  (r'/unregister%s%s' % (ARG, ARG), APIHandler, dict(task=api.unregisterRemote)),
+  (r'/remotes(?:%s)?' % ARG, APIHandler, dict(task=api.getRemotes)),
+  (r'/webhooks', APIHandler, dict(task=api.getWebhookStatus)),
+  (r'/description.xml', SSDPDescriptorHandler, dict(task=api.getSSDPDescriptor)),
+  (r'/ux', RedirectHandler, dict(url='/ux/')),
+]
+
+if cmdline.host is None:
+  routes.append((r'/ux/(.*)', NoUXHandler))
+else:
+  routes.append((r'/ux/(.*)', StaticFileHandler, dict(path=os.path.abspath(cmdline.host), default_filename='index.html')))
 
 # Cheap workaround to allow us to schedule work on the main thread
 main_thread = IOLoop.instance()
@@ -274,33 +196,38 @@ class WebSocket(WebSocketHandler):
   def open(self, remoteId):
     if not api.hasRemote(remoteId):
       logging.warning("No such remote registered, close connection")
-      self.finish()
+      self.close()
     else:
-      api.events.addRemote(EventHandler.Remote(self, remoteId, lambda msg: main_thread.add_callback(callback=lambda: self.write_message(msg))))
+      remote = EventHandler.Remote(self, remoteId, main_thread.add_callback)
+      workRunner.asynctask(api.events.addRemote, remote)
 
   # TODO: We don't care (for now) about origin
   def check_origin(self, origin):
     return True
 
   def on_message(self, message):
-    api.events.handleMessage(self, message)
+    # Never process messages on the IOLoop since they may end up talking to drivers
+    workRunner.asynctask(api.events.handleMessage, self, message)
 
   def on_close(self):
-    api.events.removeRemote(socket=self)
+    workRunner.asynctask(api.events.removeRemote, None, None, self)
 
 """ Finally, launch! """
 if __name__ == "__main__":
-  app.debug = False
   logging.info("multiRemote starting")
-  container = WSGIContainer(app)
-  server = Application([
-    (r'/events/(.*)', WebSocket),
-    (r'.*', FallbackHandler, dict(fallback=container))
-    ])
+  server = Application([(r'/events/(.*)', WebSocket)] + routes)
   server.listen(cmdline.port)
   if cmdline.ssdp == 'yes':
     api.ssdp.start()
   else:
     logging.warning('SSDP has been disabled from command line')
   logging.info("multiRemote running")
-  IOLoop.instance().start()
+  # Stop gracefully on SIGTERM (ie, systemd) the same way as with Ctrl-C
+  # (through the event loop, a plain signal handler doesn't wake it up)
+  asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, IOLoop.instance().stop)
+  try:
+    IOLoop.instance().start()
+  except KeyboardInterrupt:
+    pass
+  logging.info("multiRemote stopping")
+  api.shutdown()